@@ -1,15 +1,10 @@
-from dotenv import load_dotenv
 from pathlib import Path
 import os
-# Load early before anything else
-env_path = Path(__file__).parent / ".env"
-load_dotenv(dotenv_path=env_path)
-
 from typing import Optional, List, Union, Dict, Any
-from pydantic import BaseModel, Field, HttpUrl, field_validator, model_validator, ValidationInfo
+from pydantic import BaseModel, Field, HttpUrl, TypeAdapter, field_validator, model_validator, ValidationInfo
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from urllib.parse import urlparse as URL
-from functools import lru_cache
+from functools import lru_cache, cached_property
 import logging
 
 # Configure logging first
@@ -23,42 +18,99 @@ logger.info("Starting configutation initialization...")
 # Make sure logging is configured
 env_path = Path(__file__).parent / ".env"  # .env in same folder as config.py
 env_file = str(env_path.resolve())
-if env_path.is_file():
-    logger.info(f".env file found at: {env_path.resolve()}")
+env_file_exists = env_path.is_file()
+if env_file_exists:
+    logger.info(f".env file found at: {env_file}")
 else:
-    logger.warning(f".env file NOT found at expected location: {env_path.resolve()}")
+    logger.warning(f".env file NOT found at expected location: {env_file}")
 logger.info(f"Working directory: {os.getcwd()}")
 logger.info(f".env path resolved: {env_file}")
-logger.info(f".env exists: {Path(env_file).is_file()}")
+logger.info(f".env exists: {env_file_exists}")
+# None tells pydantic-settings to skip probing for the file altogether
+_env_file_arg = env_file if env_file_exists else None
+
+_AZURE_STATIC_SUFFIX = ".azurestaticapps.net"
+
+# Built once; only used when a parsed HttpUrl is actually requested
+_http_url_adapter = TypeAdapter(HttpUrl)
+
+def _check_http_url(v: Optional[str]) -> Optional[str]:
+    """Cheap scheme/host sanity check for URL settings kept as plain strings"""
+    if v is None:
+        return v
+    parsed = URL(v)
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        raise ValueError(f"Invalid http(s) URL: {v!r}")
+    return v
+
+def _mask(secret: Optional[str]) -> str:
+    """Mask a secret for logging, keeping only the last 4 characters"""
+    return '***' + secret[-4:] if secret else 'None'
 
 def parse_cors_origins(v: Union[str, List[str]]) -> List[str]:
     """Parse CORS origins from string or list"""
     if isinstance(v, str):
-        # Split by comma and clean up each URL
-        origins = [origin.strip() for origin in v.split(",")]
-        # Filter out empty strings
-        origins = [origin for origin in origins if origin]
-        # Add secure variants if needed
-        expanded_origins = []
-        for origin in origins:
-            expanded_origins.append(origin)
+        result: set[str] = set()
+        for origin in v.split(","):
+            origin = origin.strip()
+            if not origin:
+                continue
+            result.add(origin)
             # Add https variant if http is specified
             if origin.startswith("http://"):
-                expanded_origins.append(origin.replace("http://", "https://"))
+                result.add("https://" + origin[len("http://"):])
             # Add azurestaticapps.net variants
-            if "azurestaticapps.net" in origin:
-                base_domain = origin.split("://")[1].split(".azurestaticapps.net")[0]
-                expanded_origins.append(f"https://{base_domain}.azurestaticapps.net")
-                expanded_origins.append(f"http://{base_domain}.azurestaticapps.net")
-        return list(set(expanded_origins))
+            netloc = URL(origin).netloc
+            if netloc.endswith(_AZURE_STATIC_SUFFIX):
+                result.add(f"https://{netloc}")
+                result.add(f"http://{netloc}")
+        return list(result)
     elif isinstance(v, list):
         return v
     raise ValueError("CORS_ORIGINS must be a string or list")
 
+class VectorSearchSettings(BaseSettings):
+    """Vector search settings, only loaded when first needed"""
+    model_config = SettingsConfigDict(
+        env_file=_env_file_arg,
+        env_file_encoding="utf-8",
+        extra="ignore",
+        case_sensitive=False,
+        env_prefix="vector_search_",
+    )
+
+    endpoint: Optional[str] = None
+    key: Optional[str] = None
+    index_name: Optional[str] = Field(default=None, validation_alias="VECTOR_SEARCH_INDEX")
+    semantic_config: str = Field(default="azureml-default")
+    embedding_deployment: str = Field(default="text-embedding-ada-002")
+    embedding_key: Optional[str] = None
+
+    @field_validator('endpoint')
+    def validate_endpoint(cls, v):
+        return _check_http_url(v)
+
+    @cached_property
+    def endpoint_url(self) -> Optional[HttpUrl]:
+        """Fully parsed endpoint, computed on first access"""
+        if self.endpoint is None:
+            return None
+        return _http_url_adapter.validate_python(self.endpoint)
+
+    def missing_fields(self) -> List[str]:
+        """Names of the required env vars that are unset or blank"""
+        required_fields = {
+            'vector_search_endpoint': self.endpoint,
+            'vector_search_key': self.key,
+            'vector_search_index': self.index_name
+        }
+        return [field for field, value in required_fields.items()
+                if value is None or str(value).strip() == '']
+
 class Settings(BaseSettings):
     """Main application settings"""
     model_config = SettingsConfigDict(
-        env_file=env_file,
+        env_file=_env_file_arg,
         env_file_encoding="utf-8",
         extra="ignore",
         case_sensitive=False,
@@ -71,6 +123,8 @@ class Settings(BaseSettings):
     debug: bool = Field(default=False)
     host: str = Field(default="0.0.0.0")
     port: int = Field(default=8000)
+    # Server processes when started through main.py (the uvicorn CLI reads WEB_CONCURRENCY itself)
+    workers: int = Field(default_factory=lambda: os.cpu_count() or 1, validation_alias="WEB_CONCURRENCY")
 
     # CORS configuration
     cors_origins: Union[str, List[str]] = Field(
@@ -80,7 +134,7 @@ class Settings(BaseSettings):
 
     # OpenAI configuration
     openai_api_key: str = Field(...)
-    openai_api_base: HttpUrl = Field(...)
+    openai_api_base: str = Field(...)
     openai_api_version: str = Field(default="2024-05-01-preview")
     openai_deployment_name: str = Field(...)
     openai_temperature: float = Field(default=0.7)
@@ -91,22 +145,38 @@ class Settings(BaseSettings):
     
     # Vector Search configuration
     vector_search_enabled: bool = Field(default=False)
-    vector_search_endpoint: Optional[HttpUrl] = None
-    vector_search_key: Optional[str] = None
-    vector_search_index: Optional[str] = None
-    vector_search_semantic_config: str = Field(default="azureml-default")
-    vector_search_embedding_deployment: str = Field(default="text-embedding-ada-002")
-    vector_search_embedding_key: Optional[str] = None
+
+    # Blob storage for /upload-files
+    azure_storage_connection_string: Optional[str] = Field(default=None)
+    azure_storage_container: Optional[str] = Field(default=None)
+
+    # Semantic response cache (embeds the latest message with the vector search embedding deployment)
+    semantic_cache_enabled: bool = Field(default=False)
+    semantic_cache_threshold: float = Field(default=0.95)
+    semantic_cache_ttl: int = Field(default=900)
+    semantic_cache_max_entries: int = Field(default=10000)
 
     # System configuration
-    system_prompt: str = Field(
-        default=os.environ.get('SYSTEM_PROMPT')
-    )
+    system_prompt: Optional[str] = Field(default=None, validation_alias="SYSTEM_PROMPT")
 
     @field_validator('cors_origins')
     def validate_cors_origins(cls, v):
         return parse_cors_origins(v)
 
+    @field_validator('openai_api_base')
+    def validate_http_urls(cls, v):
+        return _check_http_url(v)
+
+    @cached_property
+    def openai_api_base_url(self) -> HttpUrl:
+        """Fully parsed openai_api_base, computed on first access"""
+        return _http_url_adapter.validate_python(self.openai_api_base)
+
+    @cached_property
+    def vector_search_settings(self) -> VectorSearchSettings:
+        """Vector search settings, read from the environment on first access"""
+        return VectorSearchSettings()
+
     @model_validator(mode='after')
     def validate_vector_search_config(self) -> 'Settings':
         """Validate vector search configuration after all fields are loaded"""
@@ -117,22 +187,7 @@ class Settings(BaseSettings):
         if not self.vector_search_enabled:
             return self
 
-        logger.info("Final vector search configuration check:")
-        logger.info(f"Vector Search Enabled: {self.vector_search_enabled}")
-        logger.info(f"Vector Search Endpoint: {self.vector_search_endpoint}")
-        logger.info(f"Vector Search Key: {'***' + self.vector_search_key[-4:] if self.vector_search_key else 'None'}")
-        logger.info(f"Vector Search Index: {self.vector_search_index}")
-        
-        # Check required fields
-        required_fields = {
-            'vector_search_endpoint': self.vector_search_endpoint,
-            'vector_search_key': self.vector_search_key,
-            'vector_search_index': self.vector_search_index
-        }
-        
-        missing = [field for field, value in required_fields.items() 
-                  if value is None or str(value).strip() == '']
-        
+        missing = self.vector_search_settings.missing_fields()
         if missing:
             logger.warning(
                 f"Vector search is enabled but missing required fields: {', '.join(missing)}. "
@@ -144,18 +199,22 @@ class Settings(BaseSettings):
 
     def model_post_init(self, _context):
         """Log loaded configuration for debugging"""
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
         logger.info("Loaded configuration:")
-        logger.info(f"App Name: {self.app_name}")
-        logger.info(f"Environment: {self.environment}")
-        logger.info(f"CORS Origins: {self.cors_origins}")
-        logger.info(f"Vector Search Enabled: {self.vector_search_enabled}")
-        logger.info(f"Vector Search Endpoint: {self.vector_search_endpoint}")
-        logger.info(f"Vector Search Key: {'***' + self.vector_search_key[-4:] if self.vector_search_key else 'None'}")
-        logger.info(f"Vector Search Index: {self.vector_search_index}")
-        logger.info(f"Vector Search Embedding Deployment: {self.vector_search_embedding_deployment}")
-        logger.info(f"Vector Search Embedding Key: {'***' + self.vector_search_embedding_key[-4:] if self.vector_search_embedding_key else 'None'}")
+        logger.info("App Name: %s", self.app_name)
+        logger.info("Environment: %s", self.environment)
+        logger.info("CORS Origins: %s", self.cors_origins)
+        logger.info("Vector Search Enabled: %s", self.vector_search_enabled)
 
         if self.vector_search_enabled:
+            vector_search = self.vector_search_settings
+            logger.info("Vector Search Endpoint: %s", vector_search.endpoint)
+            logger.info("Vector Search Key: %s", _mask(vector_search.key))
+            logger.info("Vector Search Index: %s", vector_search.index_name)
+            logger.info("Vector Search Embedding Deployment: %s", vector_search.embedding_deployment)
+            logger.info("Vector Search Embedding Key: %s", _mask(vector_search.embedding_key))
             logger.info("Vector search is enabled")
         else:
             logger.info("Vector search is disabled")
@@ -1,18 +1,59 @@
 import os
-import base64
+import sys
+import codecs
 import requests
-from typing import List, Dict, Optional, Union
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections import defaultdict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Union, Tuple, Iterator, Callable
+
+_CODE_EXTS = frozenset({
+    '.py', '.js', '.ts', '.jsx', '.tsx', '.java', '.kt', '.kts',
+    '.c', '.cpp', '.h', '.hpp', '.cs', '.go', '.rs', '.swift',
+    '.php', '.rb', '.scala', '.hs', '.lua', '.pl', '.sh', '.bash',
+    '.zsh', '.fish', '.r', '.m', '.sql', '.html', '.css', '.scss',
+    '.sass', '.less', '.json', '.yaml', '.yml', '.toml', '.ini',
+    '.cfg', '.conf', '.md', '.txt'
+})
+_SKIP_EXTS = frozenset({'.ico', '.svg', '.lock'})
+_RAW_MEDIA_TYPE = "application/vnd.github.raw"
+_STREAM_CHUNK_SIZE = 64 * 1024
+_EMOJI_BY_EXT = {
+    ".png": "🖼️", ".jpg": "🖼️", ".jpeg": "🖼️", ".gif": "🖼️",
+    ".md": "📝",
+}
+
+@lru_cache(maxsize=None)
+def _indent(width: int) -> str:
+    return " " * width
 
 class GitHubRepoLoader:
-    def __init__(self, access_token: str = None):
+    def __init__(self, access_token: str = None, max_workers: int = 16):
         self.access_token = access_token
+        self.max_workers = max_workers
         self.headers = {
             "Accept": "application/vnd.github+json",
             "X-GitHub-Api-Version": "2022-11-28"
         }
         if access_token:
             self.headers["Authorization"] = f"Bearer {access_token}"
+        # Shared across worker threads so connections are reused
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(32, max_workers),
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[429, 502, 503, 504]
+            )
+        )
+        self._session.mount("https://", adapter)
+        # Per-instance so the cache lives and dies with this loader and its session
+        self._cached_blob = lru_cache(maxsize=4096)(self._fetch_blob)
 
     def get_repo_contents(
         self, 
@@ -27,52 +68,90 @@ class GitHubRepoLoader:
         if recursive:
             params["recursive"] = "1"
         
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self._session.get(url, params=params)
         response.raise_for_status()
         return response.json()
 
-    def build_file_tree(self, contents: List[Dict]) -> Dict:
-        """Build a hierarchical file tree structure"""
-        tree = defaultdict(dict)
-        
+    def get_repo_tree(
+        self,
+        owner: str,
+        repo: str,
+        ref: str = "HEAD"
+    ) -> List[Dict]:
+        """Get the whole repository tree in one request via the Git Trees API"""
+        commit_url = f"https://api.github.com/repos/{owner}/{repo}/commits/{ref}"
+        response = self._session.get(commit_url)
+        response.raise_for_status()
+        tree_sha = response.json()["commit"]["tree"]["sha"]
+
+        tree_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{tree_sha}"
+        response = self._session.get(tree_url, params={"recursive": "1"})
+        response.raise_for_status()
+
+        tree_data = response.json()
+        if tree_data.get("truncated"):
+            print(f"Warning: tree for {owner}/{repo}@{ref} was truncated by GitHub")
+        return tree_data["tree"]
+
+    def build_file_tree(
+        self,
+        contents: List[Dict],
+        filter_fn: Optional[Callable[[str], bool]] = None
+    ) -> Dict:
+        """Build a hierarchical file tree structure, keeping only files accepted by filter_fn"""
+        tree: Dict = {}
+
         for item in contents:
-            if item["type"] == "dir":
+            if item["type"] == "commit":
+                # Submodule entry from the Git Trees API, nothing to fetch
+                continue
+
+            parts = item["path"].split("/")
+            is_dir = item["type"] in ("dir", "tree")
+            if not is_dir and filter_fn is not None and not filter_fn(parts[-1]):
+                continue
+
+            node = tree
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+
+            if is_dir:
                 # Add directory placeholder
-                path_parts = item["path"].split("/")
-                current_level = tree
-                for part in path_parts:
-                    if part not in current_level:
-                        current_level[part] = {}
-                    current_level = current_level[part]
+                node.setdefault(parts[-1], {})
             else:
                 # Add file to tree
-                path_parts = item["path"].split("/")
-                current_level = tree
-                for part in path_parts[:-1]:
-                    current_level = current_level.setdefault(part, {})
-                current_level[path_parts[-1]] = {
+                node[parts[-1]] = {
                     "type": "file",
                     "size": item["size"],
                     "sha": item["sha"]
                 }
-        
-        return dict(tree)
+
+        return tree
 
     def print_file_tree(self, tree: Dict, indent: int = 0) -> None:
         """Print file tree structure with indentation"""
-        for name, value in tree.items():
-            if isinstance(value, dict) and "type" not in value:
-                # It's a directory
-                print(" " * indent + f"📁 {name}/")
-                self.print_file_tree(value, indent + 4)
+        lines = []
+        # Each stack entry is a partially consumed directory listing
+        stack = [(iter(tree.items()), indent)]
+        while stack:
+            items, level = stack[-1]
+            for name, value in items:
+                pad = _indent(level)
+                if isinstance(value, dict) and "type" not in value:
+                    # It's a directory
+                    lines.append(f"{pad}📁 {name}/")
+                    stack.append((iter(value.items()), level + 4))
+                    break
+                # It's a file, 📄 is the default for code files
+                dot = name.rfind(".")
+                ext = name[dot:].lower() if dot != -1 else ""
+                file_type = _EMOJI_BY_EXT.get(ext, "📄")
+                lines.append(f"{pad}{file_type} {name} ({value['size']} bytes)")
             else:
-                # It's a file
-                file_type = "📄"  # Default for code files
-                if name.endswith((".png", ".jpg", ".jpeg", ".gif")):
-                    file_type = "🖼️"
-                elif name.endswith(".md"):
-                    file_type = "📝"
-                print(" " * indent + f"{file_type} {name} ({value['size']} bytes)")
+                stack.pop()
+
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
 
     def get_file_content(
         self, 
@@ -82,57 +161,90 @@ class GitHubRepoLoader:
     ) -> str:
         """Get content of a specific file"""
         url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        response = requests.get(url, headers=self.headers)
-        response.raise_for_status()
-        
-        content_data = response.json()
-        if content_data["encoding"] == "base64":
-            return base64.b64decode(content_data["content"]).decode("utf-8")
-        return content_data["content"]
+        # Raw media type returns the file bytes directly instead of base64 JSON
+        return self._get_raw_text(url)
+
+    def get_blob_content(
+        self,
+        owner: str,
+        repo: str,
+        sha: str
+    ) -> str:
+        """Get content of a blob by its SHA (cached, blobs are immutable)"""
+        return self._cached_blob(owner, repo, sha)
+
+    def _fetch_blob(self, owner: str, repo: str, sha: str) -> str:
+        url = f"https://api.github.com/repos/{owner}/{repo}/git/blobs/{sha}"
+        return self._get_raw_text(url)
+
+    def _get_raw_text(self, url: str) -> str:
+        """Stream a raw GitHub response and decode it incrementally as UTF-8"""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        parts = []
+        with self._session.get(url, headers={"Accept": _RAW_MEDIA_TYPE}, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=_STREAM_CHUNK_SIZE):
+                parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+        return "".join(parts)
+
+    def iter_files(self, tree: Dict, base_path: str = "") -> Iterator[Tuple[str, str, Dict]]:
+        """Yield (path, name, info) for every file in the tree"""
+        for name, value in tree.items():
+            current_path = f"{base_path}/{name}" if base_path else name
+            if isinstance(value, dict) and "type" not in value:
+                yield from self.iter_files(value, current_path)
+            else:
+                yield current_path, name, value
 
     def load_code_files(
         self, 
         owner: str, 
         repo: str, 
         tree: Dict, 
-        base_path: str = ""
+        base_path: str = "",
+        prefiltered: bool = False
     ) -> Dict[str, str]:
-        """Recursively load code files from the tree"""
-        code_files = {}
-        
-        for name, value in tree.items():
-            current_path = f"{base_path}/{name}" if base_path else name
-            
-            if isinstance(value, dict) and "type" not in value:
-                # Directory - recurse
-                code_files.update(self.load_code_files(owner, repo, value, current_path))
-            else:
-                # File - check if it's code
-                if self.is_code_file(name):
-                    try:
-                        content = self.get_file_content(owner, repo, current_path)
-                        code_files[current_path] = content
-                    except Exception as e:
-                        print(f"Error loading {current_path}: {str(e)}")
-        
-        return code_files
+        """Load code files from the tree, fetching them concurrently
+
+        Pass prefiltered=True when the tree was built with filter_fn=self.is_code_file
+        so files are not checked a second time.
+        """
+        paths = []
+        # Identical blobs (vendored or generated files) are downloaded once
+        sha_to_paths: Dict[str, List[str]] = defaultdict(list)
+        for path, name, info in self.iter_files(tree, base_path):
+            if prefiltered or self.is_code_file(name):
+                paths.append(path)
+                sha_to_paths[info["sha"]].append(path)
+
+        loaded = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.get_blob_content, owner, repo, sha): sha
+                for sha in sha_to_paths
+            }
+            for future in as_completed(futures):
+                sha = futures[future]
+                try:
+                    content = future.result()
+                except Exception as e:
+                    print(f"Error loading {', '.join(sha_to_paths[sha])}: {str(e)}")
+                    continue
+                for path in sha_to_paths[sha]:
+                    loaded[path] = content
+
+        # Keep the tree order rather than completion order
+        return {path: loaded[path] for path in paths if path in loaded}
 
     def is_code_file(self, filename: str) -> bool:
         """Check if a file is a code file (filter out assets, binaries, etc.)"""
-        code_extensions = [
-            '.py', '.js', '.ts', '.jsx', '.tsx', '.java', '.kt', '.kts', 
-            '.c', '.cpp', '.h', '.hpp', '.cs', '.go', '.rs', '.swift', 
-            '.php', '.rb', '.scala', '.hs', '.lua', '.pl', '.sh', '.bash',
-            '.zsh', '.fish', '.r', '.m', '.sql', '.html', '.css', '.scss',
-            '.sass', '.less', '.json', '.yaml', '.yml', '.toml', '.ini', 
-            '.cfg', '.conf', '.md', '.txt'
-        ]
-        
-        # Skip large files (>1MB) and hidden files
-        if filename.startswith(".") or filename.endswith((".ico", ".svg", ".lock")):
+        # Skip hidden files
+        if filename.startswith("."):
             return False
-        
-        return any(filename.endswith(ext) for ext in code_extensions)
+
+        ext = os.path.splitext(filename)[1].lower()
+        return ext not in _SKIP_EXTS and ext in _CODE_EXTS
 
 # Example usage
 if __name__ == "__main__":
@@ -142,16 +254,16 @@ if __name__ == "__main__":
     # Get repository contents
     owner = "owner_name"
     repo = "repo_name"
-    contents = loader.get_repo_contents(owner, repo)
+    contents = loader.get_repo_tree(owner, repo)
     
-    # Build and print file tree
-    file_tree = loader.build_file_tree(contents)
+    # Build and print file tree, pruned to code files up front
+    file_tree = loader.build_file_tree(contents, filter_fn=loader.is_code_file)
     print("Repository Structure:")
     loader.print_file_tree(file_tree)
     
     # Load all code files
     print("\nLoading code files...")
-    code_files = loader.load_code_files(owner, repo, file_tree)
+    code_files = loader.load_code_files(owner, repo, file_tree, prefiltered=True)
     
     print(f"\nLoaded {len(code_files)} code files:")
     for path, content in code_files.items():
@@ -1,9 +1,12 @@
 import os
+import re
 import json
 import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 import chardet
 import fitz  # PyMuPDF
-from typing import List, Dict, Optional, Tuple
+from typing import Deque, List, Dict, Optional, Tuple
 from pathlib import Path
 import docx
 import pptx
@@ -21,6 +24,106 @@ from azure.search.documents.indexes.models import (
 from azure.identity import DefaultAzureCredential
 from openai import AzureOpenAI
 
+# Snippet length the engine is detected from
+ENGINE_SNIPPET_CHARS = 2000
+# Files whose engine needs GPT are classified this many per request
+ENGINE_BATCH_SIZE = 10
+
+# Explicit engine mentions, checked in order (MOHAA content often mentions Quake 3 too)
+_ENGINE_PATTERNS = {
+    "mohaa": re.compile(r'\b(?:mohaa|medal of honor)\b', re.IGNORECASE),
+    "gtkradiant": re.compile(r'\b(?:gtk ?radiant|q3radiant)\b', re.IGNORECASE),
+    "idtech3": re.compile(r'\b(?:id ?tech ?3|quake ?(?:3|iii)|ioquake3|q3map2?)\b', re.IGNORECASE),
+}
+
+# Kept identical across requests so the provider can reuse the cached prompt prefix
+_ENGINE_BATCH_PROMPT = (
+    "Identify which game engine each numbered snippet relates to (mohaa, idtech3, gtkradiant). "
+    "Return only a JSON object mapping each snippet number to the engine name or \"unknown\", "
+    "e.g. {\"0\": \"mohaa\", \"1\": \"unknown\"}."
+)
+
+def match_game_engine(content: str) -> Optional[str]:
+    """Engine named explicitly in the snippet, None when it needs GPT"""
+    snippet = content[:ENGINE_SNIPPET_CHARS]
+    for engine, pattern in _ENGINE_PATTERNS.items():
+        if pattern.search(snippet):
+            return engine
+    return None
+
+def read_file_content(file_path: str) -> str:
+    """
+    Read any supported file type and return its text content.
+    Module level so process_folder can run it in worker processes.
+    """
+    ext = Path(file_path).suffix.lower()
+    
+    # Text-based files
+    if ext in {".txt", ".md", ".cfg", ".ini", ".shader", ".script", ".scr", ".srt", ".str"}:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+            encoding = chardet.detect(raw)['encoding'] or 'utf-8'
+            content = raw.decode(encoding, errors='ignore')
+    
+    # PDF files
+    elif ext == ".pdf":
+        content = []
+        with fitz.open(file_path) as doc:
+            for page in doc:
+                content.append(page.get_text())
+        content = "\n".join(content)
+    
+    # Word documents
+    elif ext == ".docx":
+        doc = docx.Document(file_path)
+        content = "\n".join([para.text for para in doc.paragraphs])
+    
+    # PowerPoint
+    elif ext == ".pptx":
+        prs = pptx.Presentation(file_path)
+        content = []
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if hasattr(shape, "text"):
+                    content.append(shape.text)
+        content = "\n".join(content)
+    
+    # HTML/XML
+    elif ext in {".html", ".htm", ".xml"}:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            soup = BeautifulSoup(f.read(), 'html.parser')
+            content = soup.get_text()
+    
+    # JSON
+    elif ext == ".json":
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            content = json.dumps(data, indent=2)
+    
+    # CSV/Excel
+    elif ext in {".csv", ".xlsx", ".xls"}:
+        df = pd.read_excel(file_path) if ext in {".xlsx", ".xls"} else pd.read_csv(file_path)
+        content = df.to_string()
+    
+    # PK3/ZIP files (common in idTech3)
+    elif ext == ".pk3" or ext == ".zip":
+        content = []
+        with zipfile.ZipFile(file_path) as z:
+            for name in z.namelist():
+                if not name.endswith('/'):  # Skip directories
+                    try:
+                        with z.open(name) as f:
+                            content.append(f"{name}:\n{f.read().decode('utf-8', errors='ignore')}")
+                    except:
+                        continue
+        content = "\n".join(content)
+    
+    else:
+        raise ValueError(f"Unsupported file type: {ext}")
+    
+    return content
+
+
 class GameModdingKnowledgeBase:
     def __init__(self, azure_openai_endpoint: str, azure_search_endpoint: str, index_name: str):
         self.credential = DefaultAzureCredential()
@@ -52,7 +155,10 @@ class GameModdingKnowledgeBase:
         }
 
     def detect_game_engine(self, content: str) -> str:
-        """Detect game engine from content using GPT"""
+        """Detect game engine from content, using GPT only when no engine is named"""
+        engine = match_game_engine(content)
+        if engine is not None:
+            return engine
         try:
             response = self.openai_client.chat.completions.create(
                 model="gpt-4",
@@ -61,7 +167,7 @@ class GameModdingKnowledgeBase:
                     "content": "Identify which game engine this content relates to (mohaa, idtech3, gtkradiant). Just return the engine name."
                 }, {
                     "role": "user",
-                    "content": content[:2000]  # First 2000 chars for detection
+                    "content": content[:ENGINE_SNIPPET_CHARS]  # First 2000 chars for detection
                 }],
                 temperature=0.1
             )
@@ -70,15 +176,50 @@ class GameModdingKnowledgeBase:
         except:
             return "unknown"
 
-    def extract_metadata(self, file_path: str, content: str) -> Dict:
-        """Extract metadata from file path and content"""
+    def detect_game_engines(self, contents: List[str]) -> List[str]:
+        """Detect the game engine of several contents with at most one GPT call per batch"""
+        engines = [match_game_engine(content) for content in contents]
+        pending = [i for i, engine in enumerate(engines) if engine is None]
+        for start in range(0, len(pending), ENGINE_BATCH_SIZE):
+            batch = pending[start:start + ENGINE_BATCH_SIZE]
+            snippets = "\n\n".join(
+                f"### {n}\n{contents[i][:ENGINE_SNIPPET_CHARS]}" for n, i in enumerate(batch)
+            )
+            try:
+                response = self.openai_client.chat.completions.create(
+                    model="gpt-4",
+                    messages=[{
+                        "role": "system",
+                        "content": _ENGINE_BATCH_PROMPT
+                    }, {
+                        "role": "user",
+                        "content": snippets
+                    }],
+                    temperature=0.1
+                )
+                answer = response.choices[0].message.content.strip().strip('`')
+                if answer.startswith("json"):
+                    answer = answer[4:]
+                detected = json.loads(answer)
+                if not isinstance(detected, dict):
+                    detected = {}
+            except Exception:
+                detected = {}
+            for n, i in enumerate(batch):
+                engine = str(detected.get(str(n), "")).strip().lower()
+                engines[i] = engine if engine in self.game_engines else "unknown"
+        return engines
+
+    def extract_metadata(self, file_path: str, content: str, engine: Optional[str] = None) -> Dict:
+        """Extract metadata from file path and content (engine detected when not given)"""
         file_ext = Path(file_path).suffix.lower()
         file_type = next(
             (k for k, v in self.file_types.items() if file_ext in v),
             "other"
         )
         
-        engine = self.detect_game_engine(content)
+        if engine is None:
+            engine = self.detect_game_engine(content)
         
         return {
             "file_type": file_type,
@@ -89,71 +230,7 @@ class GameModdingKnowledgeBase:
 
     def read_file(self, file_path: str) -> Tuple[str, Dict]:
         """Read any supported file type and return content + metadata"""
-        ext = Path(file_path).suffix.lower()
-        
-        # Text-based files
-        if ext in {".txt", ".md", ".cfg", ".ini", ".shader", ".script", ".scr", ".srt", ".str"}:
-            with open(file_path, 'rb') as f:
-                raw = f.read()
-                encoding = chardet.detect(raw)['encoding'] or 'utf-8'
-                content = raw.decode(encoding, errors='ignore')
-        
-        # PDF files
-        elif ext == ".pdf":
-            content = []
-            with fitz.open(file_path) as doc:
-                for page in doc:
-                    content.append(page.get_text())
-            content = "\n".join(content)
-        
-        # Word documents
-        elif ext == ".docx":
-            doc = docx.Document(file_path)
-            content = "\n".join([para.text for para in doc.paragraphs])
-        
-        # PowerPoint
-        elif ext == ".pptx":
-            prs = pptx.Presentation(file_path)
-            content = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        content.append(shape.text)
-            content = "\n".join(content)
-        
-        # HTML/XML
-        elif ext in {".html", ".htm", ".xml"}:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                soup = BeautifulSoup(f.read(), 'html.parser')
-                content = soup.get_text()
-        
-        # JSON
-        elif ext == ".json":
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                content = json.dumps(data, indent=2)
-        
-        # CSV/Excel
-        elif ext in {".csv", ".xlsx", ".xls"}:
-            df = pd.read_excel(file_path) if ext in {".xlsx", ".xls"} else pd.read_csv(file_path)
-            content = df.to_string()
-        
-        # PK3/ZIP files (common in idTech3)
-        elif ext == ".pk3" or ext == ".zip":
-            content = []
-            with zipfile.ZipFile(file_path) as z:
-                for name in z.namelist():
-                    if not name.endswith('/'):  # Skip directories
-                        try:
-                            with z.open(name) as f:
-                                content.append(f"{name}:\n{f.read().decode('utf-8', errors='ignore')}")
-                        except:
-                            continue
-            content = "\n".join(content)
-        
-        else:
-            raise ValueError(f"Unsupported file type: {ext}")
-        
+        content = read_file_content(file_path)
         metadata = self.extract_metadata(file_path, content)
         return content, metadata
 
@@ -230,19 +307,50 @@ class GameModdingKnowledgeBase:
     def process_folder(self, folder_path: str) -> List[Dict]:
         """Process all supported files in a folder"""
         documents = []
+        file_paths = (
+            os.path.join(root, file)
+            for root, _, files in os.walk(folder_path)
+            for file in files
+        )
         
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    content, metadata = self.read_file(file_path)
-                    chunks = self.chunk_content(content, metadata)
-                    documents.extend(chunks)
-                    print(f"Processed {file_path} ({len(chunks)} chunks)")
-                except ValueError as e:
-                    print(f"Skipping {file_path}: {str(e)}")
-                except Exception as e:
-                    print(f"Error processing {file_path}: {str(e)}")
+        # Parsing (PDF, Office, Excel, chardet, pk3) runs in worker processes, results are
+        # consumed in walk order. Only a bounded number of files are submitted ahead of the
+        # consumer, so parsed contents waiting to be chunked stay within a few windows
+        workers = os.cpu_count() or 1
+        max_ahead = ENGINE_BATCH_SIZE * workers
+        pending: Deque[Tuple[str, Future]] = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            def submit_ahead():
+                while len(pending) < max_ahead:
+                    file_path = next(file_paths, None)
+                    if file_path is None:
+                        break
+                    pending.append((file_path, executor.submit(read_file_content, file_path)))
+            
+            submit_ahead()
+            # Files are handled in windows so engine detection needs at most one GPT call each
+            while pending:
+                loaded = []
+                for _ in range(min(ENGINE_BATCH_SIZE, len(pending))):
+                    # Popping drops the queue's reference, the content lives on in `loaded` only
+                    file_path, future = pending.popleft()
+                    try:
+                        loaded.append((file_path, future.result()))
+                    except ValueError as e:
+                        print(f"Skipping {file_path}: {str(e)}")
+                    except Exception as e:
+                        print(f"Error processing {file_path}: {str(e)}")
+                submit_ahead()
+                
+                engines = self.detect_game_engines([content for _, content in loaded])
+                for (file_path, content), engine in zip(loaded, engines):
+                    try:
+                        metadata = self.extract_metadata(file_path, content, engine)
+                        chunks = self.chunk_content(content, metadata)
+                        documents.extend(chunks)
+                        print(f"Processed {file_path} ({len(chunks)} chunks)")
+                    except Exception as e:
+                        print(f"Error processing {file_path}: {str(e)}")
         
         return documents
 
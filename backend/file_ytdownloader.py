@@ -3,14 +3,31 @@ import subprocess
 import os
 import json
 import re
-from youtube_transcript_api import YouTubeTranscriptApi
-import requests
-from openai import OpenAI
-import multiprocessing
+import asyncio
 import time
+import heapq
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
+import numpy as np
+try:
+    import uvloop  # Not available on Windows
+except ImportError:
+    uvloop = None
+from youtube_transcript_api import YouTubeTranscriptApi
+import aiohttp
+import aiofiles
+from openai import AsyncOpenAI
+from diskcache import Cache
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from aiolimiter import AsyncLimiter
 import uuid
 
 # Load OpenAI API key from file
+@lru_cache(maxsize=1)
 def load_api_key():
     try:
         with open("openaikey.txt", "r") as file:
@@ -23,6 +40,7 @@ def load_api_key():
         sys.exit(1)
 
 # Load OpenAI prompt content from file
+@lru_cache(maxsize=1)
 def load_prompt():
     try:
         with open("openaiprompt.txt", "r") as file:
@@ -35,6 +53,7 @@ def load_prompt():
         sys.exit(1)
 
 # Load OpenAI tags content from file
+@lru_cache(maxsize=1)
 def load_tags():
     try:
         with open("openaitags.txt", "r") as file:
@@ -68,52 +87,139 @@ def check_ffmpeg_installed():
         print("Error: ffmpeg is not installed or cannot be found.")
         sys.exit(1)
 
-# Check if yt-dlp is installed
-check_tool_installed("yt-dlp")
-check_ffmpeg_installed()  # Ensures ffmpeg is available
+# One-time setup, run from main() rather than at import time
+def init():
+    # yt-dlp runs in-process through its Python API, only ffmpeg has to be on the PATH
+    check_ffmpeg_installed()  # Ensures ffmpeg is available
+    get_openai_client()  # Exit early if openaikey.txt is missing
 
 
 ########################################
 ########################################
-# Initialize OpenAI client
-api_key = load_api_key()
-openai_client = OpenAI(api_key=api_key)
+# Initialize OpenAI client, created once on first use
+@lru_cache(maxsize=1)
+def get_openai_client():
+    return AsyncOpenAI(api_key=load_api_key())
+
+# Maximum number of videos processed concurrently, keeps OpenAI calls under the rate limit
+MAX_CONCURRENT_VIDEOS = 50
+
+# The hot chat completion calls go straight to the REST API over our aiohttp session,
+# the SDK's httpx transport stops scaling at high concurrency
+OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+
+# Token buckets pacing requests to each service (requests per minute)
+oai_limiter = AsyncLimiter(max_rate=500, time_period=60)
+yt_limiter = AsyncLimiter(max_rate=60, time_period=60)
+
+# Disk cache for YouTube titles, transcripts and thumbnails keyed by video_id,
+# re-running the same video list skips the network (and YouTube's 429s).
+# Opened on first use so importing the module doesn't create .cache/
+@lru_cache(maxsize=1)
+def get_yt_cache():
+    return Cache(os.path.join(".cache", "yt"))
+
+METADATA_CACHE_EXPIRE = 24 * 60 * 60  # 24h
+TRANSCRIPT_CACHE_EXPIRE = 7 * 24 * 60 * 60  # 7 days
+THUMBNAIL_RESOLUTIONS = ("maxresdefault", "hqdefault")
+
+# Disk cache for chat completion results keyed by a hash of the request (model + prompt + text),
+# re-running unchanged transcripts costs no OpenAI calls
+@lru_cache(maxsize=1)
+def get_openai_cache():
+    return Cache(os.path.join(".cache", "openai"))
+
+OPENAI_CACHE_EXPIRE = 30 * 24 * 60 * 60  # 30 days
+
+# diskcache reads/writes are SQLite + file I/O, keep them off the event loop
+async def _cache_get(get_cache, key):
+    return await asyncio.to_thread(lambda: get_cache().get(key))
+
+async def _cache_set(get_cache, key, value, expire):
+    await asyncio.to_thread(lambda: get_cache().set(key, value, expire=expire))
+
+# YouTube watch/embed/short URL -> video id, compiled once
+_VIDEO_ID_RE = re.compile(r'(?:https?:\/\/)?(?:www\.)?(?:youtube\.com\/(?:watch\?v=|embed\/|v\/|.+\?v=)?|youtu\.be\/)([^&\n?#]+)')
+
+# Statuses worth retrying (rate limited / temporary server errors)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def _is_retryable(exc):
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRY_STATUSES
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+# Retry 429/5xx and connection errors with jittered exponential backoff
+_retry_http = retry(retry=retry_if_exception(_is_retryable), stop=stop_after_attempt(4),
+                    wait=wait_exponential_jitter(initial=0.5, max=8), reraise=True)
+
+@_retry_http
+async def _http_get(session, url, **kwargs):
+    """Rate limited GET to YouTube on the shared session"""
+    async with yt_limiter:
+        response = await session.get(url, **kwargs)
+    if response.status in RETRY_STATUSES:
+        response.release()
+        response.raise_for_status()
+    return response
+
+# All JSON files go through orjson (C encoder/decoder, writes UTF-8 bytes directly)
+def _json_dump(data, path):
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def _json_load(path):
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+# Same as _json_dump without blocking the event loop while other videos are in flight
+async def _json_dump_async(data, path):
+    async with aiofiles.open(path, 'wb') as f:
+        await f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 #
 
 #download video from Youtube and merge if needed, custom title can be added
 def download_video(url, output_directory, mergeOutput=True, custom_title=None):
+    """
+    Downloads the video with the in-process yt-dlp API (no subprocess/re-import per video).
+    Returns yt-dlp's info dict (title, id, thumbnail, ...) or None on failure.
+    """
     try:
         # Determine the title to use: either the custom title or the video title
         title_to_use = custom_title if custom_title else "%(title)s"
+        if not mergeOutput and not custom_title:
+            # Separate files are looked up by name afterwards, so the name must be known up front
+            title_to_use = extract_video_id(url)
 
+        ydl_options = {"outtmpl": f"{output_directory}/{title_to_use}.%(ext)s"}
         if mergeOutput:
-            # Command to download and automatically merge the video and audio
-            command = f'yt-dlp "{url}" -f "bestvideo+bestaudio" --merge-output-format mp4 -o "{output_directory}/{title_to_use}.%(ext)s" --postprocessor-args "-c:v libx264 -c:a aac -strict experimental"'
+            # Download and automatically merge the video and audio
+            ydl_options.update({
+                "format": "bestvideo+bestaudio",
+                "merge_output_format": "mp4",
+                "postprocessor_args": {"default": ["-c:v", "libx264", "-c:a", "aac", "-strict", "experimental"]}
+            })
         else:
-            # Command to download video and audio separately without NO merging
-            command = f'yt-dlp "{url}" -f "bestvideo[ext=mp4][vcodec!^=av0][vcodec!^=av1]+bestaudio[ext=m4a]" -o "{output_directory}/{title_to_use}.%(ext)s"'
+            # Download video and audio separately without NO merging
+            ydl_options["format"] = "bestvideo[ext=mp4][vcodec!^=av0][vcodec!^=av1]+bestaudio[ext=m4a]"
 
-        # Run the download command
-        subprocess.run(command, shell=True, check=True)
+        # YoutubeDL keeps per-download state, so each (threaded) call gets its own instance
+        with YoutubeDL(ydl_options) as ydl:
+            info = ydl.extract_info(url, download=True)
 
         # If merging is enabled, check if video and audio files are separate and merge them
         if not mergeOutput:
-            video_file = None
-            audio_file = None
+            # The output template gives the exact names of the separate video and audio files
+            video_file = os.path.join(output_directory, f"{title_to_use}.mp4")
+            audio_file = os.path.join(output_directory, f"{title_to_use}.m4a")
 
-            # Loop through the files in the output directory to find the separate video and audio files
-            for file in os.listdir(output_directory):
-                if file.endswith(".mp4"):
-                    video_file = os.path.join(output_directory, file)
-                if file.endswith(".m4a"):
-                    audio_file = os.path.join(output_directory, file)
-
-            if video_file and audio_file:
+            if os.path.exists(video_file) and os.path.exists(audio_file):
                 # Use ffmpeg to merge the video and audio into a single MP4 file
                 merged_file = os.path.join(output_directory, f"{os.path.splitext(os.path.basename(video_file))[0]}.mp4")
-                merge_command = f"ffmpeg -i \"{video_file}\" -i \"{audio_file}\" -c:v copy -c:a aac -strict experimental \"{merged_file}\""
-                subprocess.run(merge_command, shell=True, check=True)
+                merge_command = ["ffmpeg", "-i", video_file, "-i", audio_file, "-c:v", "copy", "-c:a", "aac",
+                                 "-strict", "experimental", merged_file]
+                subprocess.run(merge_command, check=True)
 
                 # Remove the original separate video and audio files after merging (optional)
                 os.remove(video_file)
@@ -125,69 +231,108 @@ def download_video(url, output_directory, mergeOutput=True, custom_title=None):
         else:
             print("Video and audio were already merged successfully during download.")
 
-    except subprocess.CalledProcessError as e:
+        return info
+
+    except (DownloadError, subprocess.CalledProcessError) as e:
         print(f'Error: Failed to download or merge video/audio. {e}')
+        return None
 
 def extract_video_id(url):
-    regex = r'(?:https?:\/\/)?(?:www\.)?(?:youtube\.com\/(?:watch\?v=|embed\/|v\/|.+\?v=)?|youtu\.be\/)([^&\n?#]+)'
-    match = re.match(regex, url)
+    match = _VIDEO_ID_RE.search(url)
     return match.group(1) if match else None
 
 def get_transcript(video_id):
+    cache_key = ("transcript", video_id)
+    transcript = get_yt_cache().get(cache_key)
+    if transcript is not None:
+        return transcript
     try:
         transcript = YouTubeTranscriptApi.get_transcript(video_id)
+        get_yt_cache().set(cache_key, transcript, expire=TRANSCRIPT_CACHE_EXPIRE)
         return transcript
     except Exception as e:
         print(f"Error fetching transcript: {e}")
         return None
 
-def save_transcript_as_json(transcript, output_file):
+async def save_transcript_as_json(transcript, output_file):
     try:
-        with open(output_file, 'w') as f:
-            json.dump(transcript, f, indent=4)
+        await _json_dump_async(transcript, output_file)
     except Exception as e:
         print(f"Error saving transcript to JSON: {e}")
 
 #Get video title
-def get_video_title(url):
-    oembed_url = f'https://www.youtube.com/oembed?url={url}&format=json'
+async def get_video_title(url, session):
+    cache_key = ("title", extract_video_id(url) or url)
+    title = await _cache_get(get_yt_cache, cache_key)
+    if title is not None:
+        return title
+    oembed_url = 'https://www.youtube.com/oembed'
     try:
-        response = requests.get(oembed_url)
-        response.raise_for_status()
-        data = response.json()
+        async with await _http_get(session, oembed_url, params={"url": url, "format": "json"}) as response:
+            response.raise_for_status()
+            data = await response.json()
+        await _cache_set(get_yt_cache, cache_key, data['title'], METADATA_CACHE_EXPIRE)
         return data['title']
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"Error fetching video title: {e}")
         return None
 
 #Summarise transcript text with openai
-def summarize_text(text):
+def build_summary_request(text):
+    """Chat completion parameters for summarising a transcript"""
     prompt_content = load_prompt()
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {
+                "role": "system",
+                "content": prompt_content
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ],
+        "temperature": 0,
+        "max_tokens": 2048
+    }
+
+@_retry_http
+async def create_chat_completion(request, session):
+    """POST a chat completion request and return the message content"""
+    headers = {"Authorization": f"Bearer {load_api_key()}"}
+    async with oai_limiter:
+        async with session.post(OPENAI_CHAT_COMPLETIONS_URL, json=request, headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data["choices"][0]["message"]["content"]
+
+def _completion_cache_key(request):
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def get_cached_completion(request):
+    return await _cache_get(get_openai_cache, _completion_cache_key(request))
+
+async def cached_chat_completion(request, session):
+    """create_chat_completion, cache hits return before touching the rate limiter"""
+    key = _completion_cache_key(request)
+    content = await _cache_get(get_openai_cache, key)
+    if content is None:
+        content = await create_chat_completion(request, session)
+        await _cache_set(get_openai_cache, key, content, OPENAI_CACHE_EXPIRE)
+    return content
+
+async def summarize_text(text, session):
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt_content
-                },
-                {
-                    "role": "user",
-                    "content": text
-                }
-            ],
-            temperature=0,
-            max_tokens=2048
-        )
-        return response.choices[0].message.content
+        return await cached_chat_completion(build_summary_request(text), session)
     except Exception as e:
         print(f"Error summarizing text: {e}")
         return None
     
 # Generate tags
-def generate_tags(text, title=None):
+def build_tags_request(text, title=None):
     """
-    Generate relevant tags for the video.
+    Chat completion parameters for tag generation.
     Optionally use the title as part of the text, but filter it first to remove excess details.
     """
     # Clean the title if it's provided
@@ -203,43 +348,51 @@ def generate_tags(text, title=None):
         "Avoid duplicates or overly generic terms.\n"
         f"Example tags from similar content include: {prompt_content}"
     )
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 2048
+    }
+
+def parse_tags(content):
+    """Turn the raw model output into a clean, comma-separated tag string"""
+    # Process response to remove duplicates and clean tags
+    raw_tags = content.strip().split("\n")
+    unique_tags = set(tag.strip() for tag in raw_tags if tag.strip())  # Remove duplicates and empty tags
     
+    # Clean and optimize tags
+    cleaned_tags = clean_tags(sorted(unique_tags))  # Clean and sort tags
+    
+    # Return tags as a single comma-separated string
+    return ", ".join(cleaned_tags)  # Join the tags into a single string
+
+async def generate_tags(text, session, title=None):
+    """
+    Generate relevant tags for the video.
+    Optionally use the title as part of the text, but filter it first to remove excess details.
+    """
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            max_tokens=2048
-        )
-        
-        # Process response to remove duplicates and clean tags
-        raw_tags = response.choices[0].message.content.strip().split("\n")
-        unique_tags = set(tag.strip() for tag in raw_tags if tag.strip())  # Remove duplicates and empty tags
-        
-        # Clean and optimize tags
-        cleaned_tags = clean_tags(sorted(unique_tags))  # Clean and sort tags
-        
-        # Return tags as a single comma-separated string
-        return ", ".join(cleaned_tags)  # Join the tags into a single string
+        content = await cached_chat_completion(build_tags_request(text, title), session)
+        return parse_tags(content)
     except Exception as e:
         print(f"Error generating tags: {e}")
         return None
 
+# List of common unwanted keywords/phrases to remove, as one precompiled alternation
+_UNWANTED_TITLE_PHRASES = [
+    "Official", "Full", "HD", "Trailer", "Preview", "Watch now", "Live", "Episode", "Vlog", "Music Video"
+]
+_UNWANTED_TITLE_RE = re.compile("|".join(re.escape(phrase.lower()) for phrase in _UNWANTED_TITLE_PHRASES))
+
 # Clean title for tags
 def clean_title_for_tags(title):
     """
     Clean and shorten the video title to remove unnecessary or common phrases.
     This can include things like 'Watch now', 'Official', 'Full video', etc.
     """
-    # List of common unwanted keywords/phrases to remove
-    unwanted_phrases = [
-        "Official", "Full", "HD", "Trailer", "Preview", "Watch now", "Live", "Episode", "Vlog", "Music Video"
-    ] 
-    
-    # Lowercase and clean unwanted phrases from the title
-    cleaned_title = title.lower()
-    for phrase in unwanted_phrases:
-        cleaned_title = cleaned_title.replace(phrase.lower(), "")
+    # Lowercase and clean unwanted phrases from the title in one pass
+    cleaned_title = _UNWANTED_TITLE_RE.sub("", title.lower())
     
     # Optionally truncate if title is too long
     cleaned_title = " ".join(cleaned_title.split()[:15])  # Keeping first 15 words
@@ -254,53 +407,38 @@ def clean_tags(tags):
     - Eliminates overly generic or repetitive phrases
     - Shortens excessively long lists
     """
-    # Deduplicate tags by converting to a set
-    unique_tags = list(set(tags))
-    
-    # Filter out generic words and redundant phrases
-    filtered_tags = []
+    # Filter out generic words and redundant phrases in a single pass,
+    # an insertion-ordered dict deduplicates the simplified tags
+    final_tags = {}
     seen_words = set()
-    for tag in unique_tags:
+    for tag in tags:
         # Simplify tag by splitting into words and avoiding repeats
         words = tag.lower().split()
         simplified_tag = " ".join(word for word in words if word not in seen_words)
         seen_words.update(words)
-        filtered_tags.append(simplified_tag.strip())
-    
-    # Deduplicate again to remove any repeated tags from the final list
-    final_tags = list(set(filtered_tags))  # Remove duplicates after filtering
+        if simplified_tag:
+            final_tags.setdefault(simplified_tag, None)
     
     # Limit the number of tags to a reasonable count (e.g., max 20 tags)
     max_tags = 20
-    return sorted(final_tags)[:max_tags]  # Return the first 20 tags (or fewer if necessary)
+    return heapq.nsmallest(max_tags, final_tags)  # The first 20 tags in sorted order (or fewer if necessary)
   
-def download_youtube_thumbnail(video_id, output_directory):
+async def download_youtube_thumbnail(video_id, output_directory, session):
     """
     Downloads the YouTube thumbnail image for the given video ID.
     Saves it to the specified output directory.
     """
-    # URL for the YouTube video thumbnail (high resolution)
-    thumbnail_url = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-
     # Try downloading the image
     try:
-        # Send an HTTP request to fetch the image
-        response = requests.get(thumbnail_url, stream=True)
-        # If the high resolution isn't available, fallback to other sizes
-        if response.status_code != 200:
-            print("High resolution thumbnail not available, trying lower resolution.")
-            thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-            response = requests.get(thumbnail_url, stream=True)
-
-        if response.status_code == 200:
+        image = await fetch_thumbnail_image(video_id, session)
+        if image is not None:
             # Construct the output path
             thumbnail_path = os.path.join(output_directory, f"{video_id}_thumbnail.jpg")
-            
-            # Write the image to a file
-            with open(thumbnail_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            
+
+            # Write the image to a file without blocking the event loop
+            async with aiofiles.open(thumbnail_path, 'wb') as file:
+                await file.write(image)
+
             print(f"Thumbnail saved to: {thumbnail_path}")
             return f"{video_id}_thumbnail.jpg"
         else:
@@ -308,33 +446,99 @@ def download_youtube_thumbnail(video_id, output_directory):
     except Exception as e:
         print(f"Error downloading thumbnail: {e}")
 
-# Function to convert transcript to SRT format 
-def convert_to_srt(transcript, output_file):
-    try:
-        with open(output_file, 'w') as srt_file:
-            for i, item in enumerate(transcript):
-                start_time = item['start']
-                end_time = start_time + item['duration']
-                start_time_srt = convert_seconds_to_srt_format(start_time)
-                end_time_srt = convert_seconds_to_srt_format(end_time)
-
-                # Write the subtitle entry in SRT format
-                srt_file.write(f"{i + 1}\n")
-                srt_file.write(f"{start_time_srt} --> {end_time_srt}\n")
-                srt_file.write(f"{item['text']}\n\n")
-    except Exception as e:
-        print(f"Error converting transcript to SRT: {e}")
+async def fetch_thumbnail_image(video_id, session):
+    """
+    JPEG bytes of the best available thumbnail (high resolution first, then lower).
+    Cached per video_id + resolution so re-runs don't download it again.
+    """
+    for resolution in THUMBNAIL_RESOLUTIONS:
+        image = await _cache_get(get_yt_cache, ("thumbnail", video_id, resolution))
+        if image is not None:
+            return image
+
+    for resolution in THUMBNAIL_RESOLUTIONS:
+        thumbnail_url = f"https://img.youtube.com/vi/{video_id}/{resolution}.jpg"
+        async with await _http_get(session, thumbnail_url) as response:
+            if response.status == 200:
+                image = await response.read()
+                await _cache_set(get_yt_cache, ("thumbnail", video_id, resolution), image, METADATA_CACHE_EXPIRE)
+                return image
+        # If the high resolution isn't available, fallback to other sizes
+        if resolution != THUMBNAIL_RESOLUTIONS[-1]:
+            print("High resolution thumbnail not available, trying lower resolution.")
+    return None
+
+# Write the transcript artifacts in a single pass over the transcript
+async def emit_transcript_artifacts(transcript, video_id, output_directory):
+    """
+    Writes {video_id}.srt, {video_id}.f400.json (timestamped transcript) and
+    {video_id}.f500.json (text only) while walking the transcript once.
+    Returns the joined transcript text for the summary/tags requests.
+    """
+    texts = []
+    starts = []
+    durations = []
+    for item in transcript:
+        texts.append(item['text'])
+        starts.append(item['start'])
+        durations.append(item['duration'])
+
+    # Convert all start/end times at once
+    start_times = np.array(starts, dtype=np.float64)
+    end_times = start_times + np.array(durations, dtype=np.float64)
+    start_times_srt = convert_seconds_array_to_srt_format(start_times)
+    end_times_srt = convert_seconds_array_to_srt_format(end_times)
+
+    # Subtitle entries in SRT format
+    srt_entries = [
+        f"{i}\n{start_time_srt} --> {end_time_srt}\n{text}\n\n"
+        for i, (start_time_srt, end_time_srt, text) in enumerate(zip(start_times_srt, end_times_srt, texts), start=1)
+    ]
+
+    srt_path = os.path.join(output_directory, f"{video_id}.srt")
+    async with aiofiles.open(srt_path, 'w') as srt_file:
+        await srt_file.write("".join(srt_entries))
+
+    full_transcript = " ".join(texts)
+    await save_transcript_as_json(transcript, os.path.join(output_directory, f'{video_id}.f400.json'))
+    await save_transcript_as_json(full_transcript, os.path.join(output_directory, f'{video_id}.f500.json'))
+    return full_transcript
 
 # Helper function to format time in SRT format (HH:MM:SS,MMM)
-def convert_seconds_to_srt_format(seconds):
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = int(seconds % 60)
-    milliseconds = int((seconds % 1) * 1000)
-    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
-
-def process_video(url, output_directory, download_video_flag=True, download_thumbnail_flag=True, 
-                  download_transcript_flag=True, summary_video_flag=True, generate_tags_flag=True):
+# SRT timestamps (HH:MM:SS,mmm) for a whole array of times in seconds
+def convert_seconds_array_to_srt_format(seconds):
+    # Work in whole milliseconds so the fraction isn't lost when truncating the seconds
+    total_milliseconds = np.rint(seconds * 1000).astype(np.int64)
+    hours, remainder = np.divmod(total_milliseconds, 3600000)
+    minutes, remainder = np.divmod(remainder, 60000)
+    seconds, milliseconds = np.divmod(remainder, 1000)
+    return [
+        f"{h:02}:{m:02}:{s:02},{ms:03}"
+        for h, m, s, ms in zip(hours.tolist(), minutes.tolist(), seconds.tolist(), milliseconds.tolist())
+    ]
+
+async def save_summary(summary, video_id, output_directory, meta_data):
+    summary_json_file = os.path.join(output_directory, f'{video_id}.f600.json')
+    await _json_dump_async({"summary": summary}, summary_json_file)
+    # Update metadata with summary
+    meta_data["summary"] = f"{video_id}.f600.json"
+
+async def save_tags(tags, video_id, output_directory, meta_data):
+    # Save tags as a clean, comma-separated string in JSON file
+    tags_json_file = os.path.join(output_directory, f'{video_id}.tags.json')
+    await _json_dump_async({"tags": tags}, tags_json_file)  # Save tags as a single string
+
+    # Split the comma-separated tags into a list and update metadata
+    meta_data["tags"] = [tag.strip() for tag in tags.split(",")]  # Split the tags into a list and remove extra spaces
+
+async def process_video_async(url, output_directory, download_video_flag=True, download_thumbnail_flag=True, 
+                              download_transcript_flag=True, summary_video_flag=True, generate_tags_flag=True,
+                              batch_jobs=None, session=None):
+    """
+    Process a single video. When batch_jobs is a list, the summary and tags requests are
+    appended to it for the OpenAI Batch API instead of being sent right away.
+    session is the shared aiohttp.ClientSession used for YouTube and OpenAI requests.
+    """
     # Initialize metadata dictionary
     meta_data = {
         "url": url,
@@ -359,8 +563,21 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
     # Update metadata with video ID
     meta_data["video_id"] = video_id
 
-    # Get the video title
-    video_title = get_video_title(url)
+    # Download the video and audio if enabled, yt-dlp's info dict already has the title
+    video_title = None
+    if download_video_flag:
+        try:
+            info = await asyncio.to_thread(download_video, url, output_directory, mergeOutput=True, custom_title=video_id)
+            if info:
+                video_title = info.get("title")
+        except Exception as e:
+            error_message = f"no_video_mp4_error_{url}."
+            print(error_message)
+            update_log(video_id, error_message)
+
+    # Get the video title (oembed) when it didn't come with the download
+    if not video_title:
+        video_title = await get_video_title(url, session)
     if not video_title:
         error_message = f"no_video_title_error_{url}."
         print(error_message)
@@ -370,19 +587,10 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
     # Update metadata with title
     meta_data["title"] = video_title
 
-    # Download the video and audio if enabled
-    if download_video_flag:
-        try:
-            download_video(url, output_directory, mergeOutput=True, custom_title=video_id)
-        except Exception as e:
-            error_message = f"no_video_mp4_error_{url}."
-            print(error_message)
-            update_log(video_id, error_message)
-
     # Download the video thumbnail if enabled
     if download_thumbnail_flag:
         try:
-            thumbnail_path = download_youtube_thumbnail(video_id, output_directory)
+            thumbnail_path = await download_youtube_thumbnail(video_id, output_directory, session)
             if thumbnail_path:
                 # Update metadata with thumbnail
                 meta_data["thumbnail"] = thumbnail_path
@@ -394,25 +602,13 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
     # Get the transcript if enabled
     if download_transcript_flag:
         try:
-            transcript = get_transcript(video_id)
+            transcript = await asyncio.to_thread(get_transcript, video_id)
             if transcript:
-                # Save the transcript as a JSON file
-                output_json_file = os.path.join(output_directory, f'{video_id}.f400.json')
-                save_transcript_as_json(transcript, output_json_file)
-                # Update metadata with transcript
+                # Save the JSON, text-only and SRT versions of the transcript
+                full_transcript = await emit_transcript_artifacts(transcript, video_id, output_directory)
+                # Update metadata with the transcript files
                 meta_data["transcript_timestamp"] = f'{video_id}.f400.json'
-
-                # Generate a text-only version and save it
-                full_transcript = " ".join([item["text"] for item in transcript])
-                output_text_file = os.path.join(output_directory, f'{video_id}.f500.json')
-                save_transcript_as_json(full_transcript, output_text_file)
-                # Update metadata with transcript_string
                 meta_data["transcript_string"] = f'{video_id}.f500.json'
-
-                # Convert transcript to SRT format and save it
-                srt_file = os.path.join(output_directory, f"{video_id}.srt")
-                convert_to_srt(transcript, srt_file)
-                # Update metadata with transcript_string
                 meta_data["transcript_src"] = f"{video_id}.srt"
         except Exception as e:
             error_message = f"no_transcript_error_{url}."
@@ -422,13 +618,14 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
         # Summarize the transcript if enabled
         if summary_video_flag and download_transcript_flag:
             try:
-                summary = summarize_text(full_transcript)
-                if summary:
-                    summary_json_file = os.path.join(output_directory, f'{video_id}.f600.json')
-                    with open(summary_json_file, 'w') as f:
-                        json.dump({"summary": summary}, f, indent=4)
-                    # Update metadata with summary
-                    meta_data["summary"] = f"{video_id}.f600.json"
+                summary_request = build_summary_request(full_transcript)
+                # Only new transcripts go to the Batch API, cached ones are saved right away
+                if batch_jobs is not None and await get_cached_completion(summary_request) is None:
+                    batch_jobs.append(build_batch_job(f"{video_id}_summary", summary_request))
+                else:
+                    summary = await summarize_text(full_transcript, session)
+                    if summary:
+                        await save_summary(summary, video_id, output_directory, meta_data)
             except Exception as e:
                 error_message = f"no_summary_error_{url}."
                 print(error_message)
@@ -438,15 +635,14 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
     if generate_tags_flag:
         try:
             # Generate tags using the full transcript or just the title
-            tags = generate_tags(full_transcript if download_transcript_flag else "", title=video_title)
-            if tags:
-                # Save tags as a clean, comma-separated string in JSON file
-                tags_json_file = os.path.join(output_directory, f'{video_id}.tags.json')
-                with open(tags_json_file, 'w') as f:
-                    json.dump({"tags": tags}, f, indent=4)  # Save tags as a single string
-
-                # Split the comma-separated tags into a list and update metadata
-                meta_data["tags"] = [tag.strip() for tag in tags.split(",")]  # Split the tags into a list and remove extra spaces
+            tags_text = full_transcript if download_transcript_flag else ""
+            tags_request = build_tags_request(tags_text, title=video_title)
+            if batch_jobs is not None and await get_cached_completion(tags_request) is None:
+                batch_jobs.append(build_batch_job(f"{video_id}_tags", tags_request))
+            else:
+                tags = await generate_tags(tags_text, session, title=video_title)
+                if tags:
+                    await save_tags(tags, video_id, output_directory, meta_data)
         except Exception as e:
             error_message = f"no_tags_error_{url}."
             print(error_message)
@@ -455,91 +651,263 @@ def process_video(url, output_directory, download_video_flag=True, download_thum
 
     # Save metadata as a JSON file
     meta_data_file = os.path.join(output_directory, f'{video_id}_meta_data.json')
-    with open(meta_data_file, 'w') as f:
-        json.dump(meta_data, f, indent=4)
+    await _json_dump_async(meta_data, meta_data_file)
 
     print(f"Meta data saved for video {video_id} as {meta_data_file}")
 
 
-def process_video_wrapper(args):
-    url, output_directory, flags = args
-    process_video(url, output_directory, **flags)
+def build_batch_job(custom_id, body):
+    """One JSONL line of an OpenAI Batch API input file"""
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+async def run_openai_batch(batch_jobs, poll_interval=60):
+    """
+    Submit chat completion jobs through the OpenAI Batch API (half the token cost, separate
+    rate limit pool) and wait for them. Returns {custom_id: message content}.
+    """
+    payload = b"\n".join(orjson.dumps(job) for job in batch_jobs)
+    input_file = await get_openai_client().files.create(file=("batch_input.jsonl", payload), purpose="batch")
+    batch = await get_openai_client().batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Submitted OpenAI batch {batch.id} with {len(batch_jobs)} requests.")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await get_openai_client().batches.retrieve(batch.id)
+        print(f"OpenAI batch {batch.id} status: {batch.status}")
+
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"Error: OpenAI batch {batch.id} ended with status {batch.status}.")
+        return {}
+
+    output = await get_openai_client().files.content(batch.output_file_id)
+    requests_by_id = {job["custom_id"]: job["body"] for job in batch_jobs}
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[record["custom_id"]] = content
+        else:
+            print(f"Error in batch request {record.get('custom_id')}: {record.get('error')}")
+
+    def cache_results():
+        openai_cache = get_openai_cache()
+        for custom_id, content in results.items():
+            openai_cache.set(_completion_cache_key(requests_by_id[custom_id]), content, expire=OPENAI_CACHE_EXPIRE)
+
+    # All results are written to the cache in one worker thread call
+    await asyncio.to_thread(cache_results)
+    return results
+
+async def apply_batch_results(results, output_directory):
+    """Write summaries/tags returned by the Batch API and update each video's metadata"""
+    by_video = {}
+    for custom_id, content in results.items():
+        video_id, kind = custom_id.rsplit("_", 1)
+        by_video.setdefault(video_id, {})[kind] = content
+
+    for video_id, outputs in by_video.items():
+        meta_data_file = os.path.join(output_directory, f'{video_id}_meta_data.json')
+        try:
+            meta_data = _json_load(meta_data_file)
+
+            if outputs.get("summary"):
+                await save_summary(outputs["summary"], video_id, output_directory, meta_data)
+            if "tags" in outputs:
+                tags = parse_tags(outputs["tags"])
+                if tags:
+                    await save_tags(tags, video_id, output_directory, meta_data)
+
+            await _json_dump_async(meta_data, meta_data_file)
+        except Exception as e:
+            error_message = f"batch_result_error_{video_id}: {e}"
+            print(error_message)
+            update_log(video_id, error_message)
+
+
+async def _process_videos(video_list, output_directory, flags, use_batch_api=False):
+    """Process every video concurrently, at most MAX_CONCURRENT_VIDEOS at a time"""
+    # Summary/tag requests of the whole run, only collected when using the Batch API
+    batch_jobs = [] if use_batch_api else None
+    urls = [video.get("url") for video in video_list if video.get("url")]
+    total_videos = len(video_list)
+    videos_downloaded = 0  # Initialize the counter for downloaded videos
+
+    # One semaphore for the whole list, a slot frees up as soon as any video finishes
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_VIDEOS)
 
+    async def run_one(url):
+        nonlocal videos_downloaded
+        async with semaphore:
+            print(f"Processing video: {url}")
+            try:
+                await process_video_async(url, output_directory, batch_jobs=batch_jobs, session=session, **flags)
+            except Exception as e:
+                print(f"Error processing video {url}: {e}")
+            videos_downloaded += 1
+            print(f"{videos_downloaded}/{total_videos} videos downloaded.")
+
+    # One session for every YouTube/OpenAI request of the run so connections are reused
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, limit_per_host=32))
+    try:
+        await asyncio.gather(*(run_one(url) for url in urls))
+    finally:
+        await session.close()
+
+    if batch_jobs:
+        results = await run_openai_batch(batch_jobs)
+        await apply_batch_results(results, output_directory)
+
+
+# Append-only log of processing errors, one JSON object per line
+LOG_FILE = "logs/processed_videos_log.jsonl"
 
 # Create log file to track processed videos
 def initialize_log():
     if not os.path.exists("logs"):
         os.makedirs("logs")
     
-    log_file = "logs/processed_videos_log.json"
-    if not os.path.exists(log_file):
-        with open(log_file, 'w') as f:
-            json.dump({}, f, indent=4)
-    
-    return log_file
+    return LOG_FILE
 
-def update_log(video_id, error_message, log_file="logs/processed_videos_log.json"):
+def update_log(video_id, error_message, log_file=LOG_FILE):
     try:
-        # Read existing log data
-        with open(log_file, 'r') as f:
-            log_data = json.load(f)
-        
-        # If the video_id is not already in the log, initialize an empty list
-        if video_id not in log_data:
-            log_data[video_id] = []
-        
-        # Append the new error message
-        log_data[video_id].append(error_message)
-        
-        # Save the updated log data
-        with open(log_file, 'w') as f:
-            json.dump(log_data, f, indent=4)
-    
+        # One O(1) append per error, single small writes in append mode don't interleave
+        with open(log_file, 'ab') as f:
+            f.write(orjson.dumps({"video_id": video_id, "error": error_message, "ts": time.time()}) + b"\n")
     except Exception as e:
         print(f"Error updating log file: {e}")
 
+def compact_log(log_file=LOG_FILE, output_file="logs/processed_videos_log.json"):
+    """Collapse the JSONL log into the {video_id: [error, ...]} JSON file"""
+    log_data = {}
+    try:
+        with open(log_file, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = orjson.loads(line)
+                log_data.setdefault(entry["video_id"], []).append(entry["error"])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading log file: {e}")
+
+    _json_dump(log_data, output_file)
+    return output_file
+
+
+def _iter_meta_data_files(directory):
+    """Recursively yield the paths of *_meta_data.json files (scandir, no extra stat calls)"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_meta_data_files(entry.path)
+            elif entry.name.endswith('_meta_data.json'):
+                yield entry.path
+
+def _load_meta_data(file):
+    try:
+        return _json_load(file)
+    except orjson.JSONDecodeError:
+        print(f"Warning: Failed to decode JSON from file {file}. Skipping...")
+    except Exception as e:
+        print(f"Error: {e} while processing file {file}. Skipping...")
+    return None
+
+# Number of meta data files read in parallel before they are written out
+MERGE_CHUNK_SIZE = 256
 
 def merge_meta_data_jsons(input_directory, output_directory):
     # Ensure the output directory exists
     os.makedirs(output_directory, exist_ok=True)
 
     # Find all JSON files ending with _meta_data.json in the input directory
-    meta_data_files = [
-        os.path.join(root, file)
-        for root, _, files in os.walk(input_directory)
-        for file in files if file.endswith('_meta_data.json')
-    ]
+    meta_data_files = list(_iter_meta_data_files(input_directory))
 
     if not meta_data_files:
         print("No meta_data.json files found in the directory.")
         return
 
-    merged_data = []
-
-    # Read and merge the JSON files
-    for file in meta_data_files:
-        try:
-            with open(file, 'r') as f:
-                data = json.load(f)
-                merged_data.append(data)
-        except json.JSONDecodeError:
-            print(f"Warning: Failed to decode JSON from file {file}. Skipping...")
-        except Exception as e:
-            print(f"Error: {e} while processing file {file}. Skipping...")
-
     # Generate a random ID for the merged file
     random_id = str(uuid.uuid4())[:6]
     output_file = os.path.join(output_directory, f'{random_id}_merged.json')
 
-    # Save the merged data
-    with open(output_file, 'w') as f:
-        json.dump(merged_data, f, indent=4)
+    # Stream the merged array to disk one record at a time. Files are read and parsed
+    # in parallel, a chunk at a time, so memory stays bounded by the chunk not the total
+    with open(output_file, 'wb') as f, ThreadPoolExecutor(max_workers=16) as executor:
+        f.write(b'[')
+        first = True
+        for start in range(0, len(meta_data_files), MERGE_CHUNK_SIZE):
+            chunk = meta_data_files[start:start + MERGE_CHUNK_SIZE]
+            for data in executor.map(_load_meta_data, chunk):
+                if data is None:
+                    continue
+                f.write((b'\n' if first else b',\n') + orjson.dumps(data))
+                first = False
+        f.write(b'\n]')
 
     print(f"Merged JSON saved to {output_file}")
     return f'{random_id}_merged.json'
 
  
 
+def _iter_json_array(path, chunk_size=1024 * 1024):
+    """
+    Yield the elements of a top-level JSON array one by one, reading the file in chunks
+    so only the current element is held in memory (orjson has no incremental decoder).
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        # Leading whitespace may span more than one chunk
+        buffer = ''
+        while not buffer:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer = chunk.lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        eof = False
+        while True:
+            # Skip whitespace and separators between elements, reading more when needed
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                buffer, position = f.read(chunk_size), 0
+                eof = not buffer
+
+            if position >= len(buffer) or buffer[position] == ']':
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                # A scalar cut at the end of the buffer still decodes (123456 -> 12, 0.5 -> 0),
+                # only trust it once a separator follows it
+                complete = eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]')
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # The element continues in the next chunk
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+
+            yield element
+            position = end
+
 def limit_tags(json_file_path, output_file_path, max_tags=20):
     """
     Limits the number of tags in each video entry to the specified maximum.
@@ -549,18 +917,14 @@ def limit_tags(json_file_path, output_file_path, max_tags=20):
         output_file_path (str): Path to save the updated JSON file.
         max_tags (int): Maximum number of tags allowed per video entry.
     """
-    # Read the JSON file
-    with open(json_file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-
-    # Iterate through each video entry and limit the tags
-    for video in data:
-        if 'tags' in video and isinstance(video['tags'], list):
-            video['tags'] = video['tags'][:max_tags]  # Keep only the first `max_tags` tags
-
-    # Save the updated JSON back to a file
-    with open(output_file_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, indent=4, ensure_ascii=False)
+    # Stream each video entry from the input, limit its tags and write it straight back out
+    with open(output_file_path, 'wb') as file:
+        file.write(b'[')
+        for index, video in enumerate(_iter_json_array(json_file_path)):
+            if 'tags' in video and isinstance(video['tags'], list):
+                video['tags'] = video['tags'][:max_tags]  # Keep only the first `max_tags` tags
+            file.write((b',\n' if index else b'\n') + orjson.dumps(video))
+        file.write(b'\n]')
 
     print(f"Tags limited to {max_tags} per video. Updated JSON saved to {output_file_path}")
 
@@ -570,10 +934,8 @@ def main():
     output_directory = "downloads"
     # Input folder which contains [{"url": "https://www.youtube.com/watch?v={videoid}"}]
     videos_to_download_json = "video_test.json"
-    # Multi-process flag ==> Set to True for parallel downloads, False for sequential
-    multi_process_CPU_download = False  
-    # Experiment with the pool size
-    pool_size = min(multiprocessing.cpu_count(), 16)  # Set maximum pool size to 16, or the number of CPU cores, whichever is smaller
+    # Send summary/tag requests through the OpenAI Batch API (50% cheaper, results within 24h)
+    use_batch_api = False
 
     # Feature toggles
     flags = {
@@ -584,51 +946,24 @@ def main():
         "generate_tags_flag": True
     }
 
+    init()
     initialize_log()
     
     os.makedirs(output_directory, exist_ok=True)
 
     try:
-        with open(videos_to_download_json, "r") as file:
-            video_list = json.load(file)
+        video_list = _json_load(videos_to_download_json)
     except FileNotFoundError:
         print(f"Error: {videos_to_download_json} not found.")
         sys.exit(1)
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Failed to decode JSON from {videos_to_download_json}")
         sys.exit(1)
 
-    total_videos = len(video_list)
-    batch_size = 10
-    num_batches = (total_videos // batch_size) + (1 if total_videos % batch_size != 0 else 0)
-
-    videos_downloaded = 0  # Initialize the counter for downloaded videos
-
-    for batch_index in range(num_batches):
-        start_index = batch_index * batch_size
-        end_index = min((batch_index + 1) * batch_size, total_videos)
-        batch = video_list[start_index:end_index]
-
-        print(f"Processing batch {batch_index + 1}/{num_batches}, videos {start_index + 1} to {end_index}")
-
-        if multi_process_CPU_download:
-            with multiprocessing.Pool(processes=pool_size) as pool:
-                pool.map(process_video_wrapper, [(video['url'], output_directory, flags) for video in batch])
-                # Update downloaded video count after processing this batch
-                videos_downloaded += len(batch)
-        else:
-            for video in batch:
-                url = video.get("url")
-                if url:
-                    print(f"Processing video: {url}")
-                    process_video(url, output_directory, **flags)
-                    # Update downloaded video count after processing each video
-                    videos_downloaded += 1
-
-        # Display progress after each batch
-        print(f"{videos_downloaded}/{total_videos} videos downloaded.")
-        print(f"Batch {batch_index + 1} finished. Waiting before starting the next batch.")
-        time.sleep(30)
+    # Videos in a batch run concurrently on one event loop (libuv based when uvloop is available)
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(_process_videos(video_list, output_directory, flags, use_batch_api=use_batch_api))
 
     #merge meta-tags into 1 file
     input_directory = "downloads"
@@ -640,6 +975,9 @@ def main():
     output_json_path = input_directory + '/merge/' + 'fixed_' + output_file  # Path to save the updated JSON file
     limit_tags(input_json_path, output_json_path, max_tags=20)
 
+    # Write the error log in the {video_id: [errors]} shape as well
+    compact_log()
+
 
 if __name__ == "__main__":
     main()
@@ -1,27 +1,33 @@
 import logging
+import os
+import sys
 import contextlib
+import heapq
+import hashlib
+from cachetools import LRUCache, TTLCache
+from functools import lru_cache
 import weakref
 from typing import Set, Optional, Dict
 import tiktoken
 import asyncio
-import aiohttp
+import httpx
 import time
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-import json
+import orjson
+import msgspec
 import re
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from config import settings
 import uvicorn
 from fastapi import WebSocket, WebSocketDisconnect, status
 from starlette.websockets import WebSocketState
 from fastapi import FastAPI, HTTPException, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi import Form
 from fastapi import UploadFile, File, BackgroundTasks
-import difflib
 from typing import Tuple, List
 
 # Configure logging first
@@ -33,18 +39,73 @@ logger = logging.getLogger(__name__)
 logger.info("Starting application initialization...")
 
 # Create FastAPI app
-app = FastAPI(title=settings.app_name)
-
-# Initialize OpenAI client with configuration
-client = AzureOpenAI(
+# Responses are rendered with orjson (bytes straight out, no stdlib json pass)
+app = FastAPI(title=settings.app_name, default_response_class=ORJSONResponse)
+
+# Initialize OpenAI client with configuration (async, requests never block the event loop).
+# One pooled HTTP/2 keep-alive client for every OpenAI call, so requests reuse open TLS sessions
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+client = AsyncAzureOpenAI(
     azure_endpoint=str(settings.openai_api_base),
     api_key=settings.openai_api_key,
-    api_version="2024-05-01-preview"
+    api_version="2024-05-01-preview",
+    http_client=openai_http_client
 )
 
 max_completion_tokens = 10000
 max_model_tokens = 20000
 
+# System message for the configured prompt, shared by every request that doesn't override it
+_SYSTEM_MESSAGE = {"role": "system", "content": settings.system_prompt}
+
+# Recent /chat responses keyed by the embedding of the latest message
+semantic_cache = None
+if settings.semantic_cache_enabled:
+    from semantic_cache import SemanticCache, context_hash
+    semantic_cache = SemanticCache(
+        max_entries=settings.semantic_cache_max_entries,
+        ttl=settings.semantic_cache_ttl,
+        threshold=settings.semantic_cache_threshold
+    )
+# Messages shorter than this aren't worth an embedding call
+SEMANTIC_CACHE_MIN_CHARS = 16
+
+# Exact repeats of a /chat request (same messages and parameters), checked before the semantic cache
+chat_response_cache: TTLCache = TTLCache(maxsize=10_000, ttl=900)
+# Above this temperature callers expect varied answers, so responses aren't cached
+CHAT_CACHE_MAX_TEMPERATURE = 0.2
+
+# /translate runs at temperature 0, so identical requests get identical answers
+translation_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+TRANSLATION_CACHE_MAX_SOURCE = 16 * 1024  # Larger sources aren't cached to bound memory
+
+# /chat post-processing patterns and templates, compiled once
+_DOC_MARKER_RE = re.compile(r'\[doc\d+\]')
+_URL_RE = re.compile(r'(https?://[^\s]+|www\.[^\s]+)')
+_NO_INFO_RE = re.compile(r'The requested information is not (?:available|found)')
+_NO_INFO_HINT = "\nDisable RagSearch, select another Rag Database, or redefine your question."
+_CITATION_TEMPLATE = (
+    '<p style="background-color:#f3f4f6; padding:8px; border-radius:4px; margin:0px;">'
+    '<strong>[{index}]{title}</strong> – {teaser}... <details><summary style="cursor:pointer; color:#555; margin:0px; margin-top:2px;">Read more</summary>{snippet}</details>'
+    '</p>'
+)
+
+def _link_url(match: re.Match) -> str:
+    return f'<a href="{match.group(0)}" target="_blank" rel="noopener noreferrer">{match.group(0)}</a>'
+
+# Response timestamp, formatted at most once per second
+_now_iso_cache = [0, ""]
+
+def now_iso() -> str:
+    second = int(time.time())
+    if second != _now_iso_cache[0]:
+        _now_iso_cache[:] = [second, datetime.fromtimestamp(second).isoformat()]
+    return _now_iso_cache[1]
+
 # Classes
 class ChatMessage(BaseModel):
     role: str
@@ -64,6 +125,25 @@ class ChatRequest(BaseModel):
     databaseIndex: Optional[str] = None
     vectorSearchEnabled: Optional[bool] = False
 
+# msgspec mirrors of ChatMessage/ChatRequest, validates websocket messages without Pydantic
+class ChatMessageFast(msgspec.Struct):
+    role: str
+    content: str
+    timestamp: str
+
+class ChatRequestFast(msgspec.Struct, kw_only=True):
+    sessionId: str
+    messages: List[ChatMessageFast]
+    max_tokens: Optional[int] = 4000
+    temperature: Optional[float] = 0.7
+    continue_last: bool
+    systemPrompt: Optional[str] = None
+    databaseId: Optional[str] = None
+    databaseEndpoint: Optional[str] = None
+    databaseKey: Optional[str] = None
+    databaseIndex: Optional[str] = None
+    vectorSearchEnabled: Optional[bool] = False
+
 class TranslationRequest(BaseModel):
     source: str
     sourceLang: str
@@ -88,8 +168,10 @@ class CodeDiffResponse(BaseModel):
     changed_lines: List[int]
 
 class StreamMetrics:
+    __slots__ = ('start_time', 'chunk_count', 'total_tokens', 'errors')
+
     def __init__(self):
-        self.start_time = time.time()
+        self.start_time = time.monotonic()  # Only used for duration math
         self.chunk_count = 0
         self.total_tokens = 0
         self.errors = 0
@@ -103,7 +185,7 @@ class StreamMetrics:
         self.errors += 1
         
     def get_metrics(self):
-        duration = time.time() - self.start_time
+        duration = time.monotonic() - self.start_time
         return {
             "duration_seconds": round(duration, 2),
             "chunk_count": self.chunk_count,
@@ -112,32 +194,35 @@ class StreamMetrics:
             "chunks_per_second": round(self.chunk_count / duration if duration > 0 else 0, 2)
         }
 
+    def __repr__(self):
+        # Only formatted when a handler actually emits the record
+        return repr(self.get_metrics())
+
 
 #Allowed origins
-def get_allowed_origins():
-    """Get allowed origins with proper handling of wildcard domains"""
-    origins = []
+def get_allowed_origins() -> Tuple[frozenset, Optional[re.Pattern]]:
+    """
+    Get allowed origins with proper handling of wildcard domains.
+    Returns the exact origins as a frozenset and all wildcard origins as one anchored regex.
+    """
+    exact = set()
+    wildcards = []
     for origin in settings.cors_origins:
         if '*' in origin:
             # Convert wildcard pattern to regex pattern
-            pattern = re.escape(origin).replace('\\*', '.*')
-            origins.append(re.compile(pattern))
+            wildcards.append(re.escape(origin).replace('\\*', '.*'))
         else:
-            origins.append(origin)
-    return origins
+            exact.add(origin)
+    wildcard_re = re.compile('^(?:' + '|'.join(wildcards) + ')\\Z') if wildcards else None
+    return frozenset(exact), wildcard_re
 
-def is_origin_allowed(origin: str, allowed_origins) -> bool:
+def is_origin_allowed(origin: str, allowed_origins: Tuple[frozenset, Optional[re.Pattern]]) -> bool:
     """Check if origin is allowed, handling both exact matches and patterns"""
     if not origin:
         return False
     
-    for allowed_origin in allowed_origins:
-        if isinstance(allowed_origin, re.Pattern):
-            if allowed_origin.match(origin):
-                return True
-        elif origin == allowed_origin:
-            return True
-    return False
+    exact, wildcard_re = allowed_origins
+    return origin in exact or (wildcard_re is not None and wildcard_re.match(origin) is not None)
 
 allowed_origins = get_allowed_origins()
 logger.info(f"Configured CORS origins: {settings.cors_origins}")
@@ -152,26 +237,79 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-@app.middleware("http")
-async def cors_middleware(request, call_next):
-    """Custom CORS middleware to handle wildcard subdomains"""
-    origin = request.headers.get("origin")
-    logger.debug(f"Received request from origin: {origin}")
+# Constant part of the preflight response for allowed origins, already encoded for ASGI
+_PREFLIGHT_HEADERS = [
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-max-age", b"600"),
+    (b"content-length", b"0"),
+]
+
+# Constant CORS response headers, already encoded for ASGI
+_STATIC_CORS_HEADERS = [
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-expose-headers", b"*"),
+]
+_CORS_HEADER_NAMES = frozenset([b"access-control-allow-origin"] + [name for name, _ in _STATIC_CORS_HEADERS])
+
+class CorsHeaderMiddleware:
+    """
+    Custom CORS middleware to handle wildcard subdomains.
+    Plain ASGI, so requests and streamed responses pass through without BaseHTTPMiddleware's
+    per-request task group and body streams.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        raw_origin = request_method = requested_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                raw_origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                requested_headers = value
+        origin = raw_origin.decode("latin-1") if raw_origin is not None else None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received request from origin: %s", origin)
+
+        if not origin:
+            return await self.app(scope, receive, send)
+        allowed = is_origin_allowed(origin, allowed_origins)
+
+        # Answer preflight requests from allowed origins directly
+        if allowed and scope["method"] == "OPTIONS" and request_method is not None:
+            headers = [(b"access-control-allow-origin", raw_origin), *_PREFLIGHT_HEADERS]
+            headers.append((b"access-control-allow-headers", requested_headers or b"*"))
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
 
-    response = await call_next(request)
-    
-    if origin:
-        if is_origin_allowed(origin, allowed_origins):
-            response.headers["Access-Control-Allow-Origin"] = origin
-            response.headers["Access-Control-Allow-Credentials"] = "true"
-            response.headers["Access-Control-Allow-Methods"] = "*"
-            response.headers["Access-Control-Allow-Headers"] = "*"
-            response.headers["Access-Control-Expose-Headers"] = "*"
-            logger.debug(f"CORS headers set for origin: {origin}")
-        else:
+        if not allowed:
             logger.warning(f"Origin not allowed: {origin}")
-    
-    return response
+            return await self.app(scope, receive, send)
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                # Replace any CORS headers set further down the stack in one pass
+                headers = [header for header in message.get("headers", ()) if header[0] not in _CORS_HEADER_NAMES]
+                headers.append((b"access-control-allow-origin", raw_origin))
+                headers.extend(_STATIC_CORS_HEADERS)
+                message["headers"] = headers
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("CORS headers set for origin: %s", origin)
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(CorsHeaderMiddleware)
 
 
 async def monitor_stream(stream):
@@ -185,7 +323,7 @@ async def monitor_stream(stream):
                 metrics.record_error()
                 logger.error(f"Error processing chunk: {e}")
     finally:
-        logger.info(f"Stream metrics: {metrics.get_metrics()}")
+        logger.info("Stream metrics: %r", metrics)
 
 
 async def validate_openai_config():
@@ -196,7 +334,7 @@ async def validate_openai_config():
         logger.info(f"API Version: {settings.openai_api_version}")
         logger.info(f"Deployment Name: {settings.openai_deployment_name}")
         
-        test_completion = client.chat.completions.create(
+        test_completion = await client.chat.completions.create(
             model=settings.openai_deployment_name,
             messages=[{"role": "user", "content": "test"}],
             max_tokens=10,
@@ -210,13 +348,37 @@ async def validate_openai_config():
         logger.exception(e)
         return False
 
-@app.on_event("startup")
-async def startup_event():
-    """Validate configuration on startup"""
+async def _validate_openai_config_in_background():
     if not await validate_openai_config():
         logger.error("Failed to validate OpenAI configuration")
         # You might want to exit here or handle the error differently
 
+_startup_tasks: Set[asyncio.Task] = set()
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    Validate configuration on startup (this also opens the first pooled connection).
+    Runs in the background so the app starts serving without waiting on an LLM round trip.
+    """
+    for coro in (
+        _validate_openai_config_in_background(),
+        # Load the tokenizer off the event loop so the first request doesn't pay for it
+        asyncio.to_thread(get_encoder, settings.openai_deployment_name),
+    ):
+        task = asyncio.create_task(coro)
+        _startup_tasks.add(task)
+        task.add_done_callback(_startup_tasks.discard)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the pooled OpenAI and blob storage connections"""
+    for task in _startup_tasks:
+        task.cancel()
+    await client.close()
+    if blob_service_client.cache_info().currsize:
+        await blob_service_client().close()
+
 @app.get("/")
 async def root():
     """Root endpoint for debugging"""
@@ -238,19 +400,16 @@ async def health():
         "app_name": settings.app_name,
         "environment": settings.environment,
         "vector_search_enabled": settings.vector_search_enabled,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """HTTP endpoint for chat functionality"""
     logger.info("Received chat request")
-    logger.debug(f"Request body: {request}")
+    logger.debug("Request body: %s", request)
     
     system_prompt = request.systemPrompt or settings.system_prompt
-    search_endpoint = request.databaseEndpoint or settings.vector_search_endpoint
-    search_key = request.databaseKey or settings.vector_search_key
-    search_index = request.databaseIndex or settings.vector_search_index
     vector_search_enabled = (
         request.vectorSearchEnabled 
         if request.vectorSearchEnabled is not None 
@@ -258,18 +417,38 @@ async def chat(request: ChatRequest):
     )
 
     try:
-        messages = [
+        system_message = (
             {"role": "system", "content": system_prompt}
-        ] + [
-            {"role": m.role, "content": m.content} 
-            for m in request.messages
-        ]
+            if system_prompt != settings.system_prompt
+            else _SYSTEM_MESSAGE
+        )
+        messages = [system_message, *({"role": m.role, "content": m.content} for m in request.messages)]
         
         if vector_search_enabled:
             logger.info("Using vector search for this chat request")
         else:
             logger.info("Not using vector search for this chat request")
 
+        # Same request or a semantically equivalent question in the same context: answer from the cache
+        cache_entry = exact_key = None
+        cacheable = not request.continue_last and (request.temperature or 0) <= CHAT_CACHE_MAX_TEMPERATURE
+        if cacheable:
+            exact_key = hashlib.blake2b(
+                orjson.dumps([messages, request.max_tokens, request.temperature, vector_search_enabled]),
+                digest_size=16
+            ).digest()
+            cached = chat_response_cache.get(exact_key)
+            if cached is not None:
+                logger.info("Exact cache hit for chat request")
+                return {**cached, "timestamp": now_iso()}
+        if semantic_cache is not None and cacheable:
+            cache_entry = await semantic_cache_entry(messages, vector_search_enabled)
+            if cache_entry is not None:
+                cached = semantic_cache.get(*cache_entry)
+                if cached is not None:
+                    logger.info("Semantic cache hit for chat request")
+                    return {**cached, "timestamp": now_iso()}
+
         completion = await generate_chat_completion(
             messages=messages,
             max_tokens=request.max_tokens,
@@ -296,28 +475,23 @@ async def chat(request: ChatRequest):
 
         # --- Step 2: Sanitize [docX] markers from the content ---
         raw_response = completion.choices[0].message.content
-        clean_response = re.sub(r'\[doc\d+\]', '', raw_response).strip()
-        if "The requested information is not available" in clean_response:
+        clean_response = _DOC_MARKER_RE.sub('', raw_response).strip()
+        # The model found nothing in the index: drop the citations and add a hint instead
+        no_info = _NO_INFO_RE.search(clean_response) is not None
+        if no_info:
             retrieved_docs = []
 
-        def auto_link(text):
-            url_pattern = re.compile(r'(https?://[^\s]+|www\.[^\s]+)')
-            return url_pattern.sub(lambda m: f'<a href="{m.group(0)}" target="_blank" rel="noopener noreferrer">{m.group(0)}</a>', text)
-
         # --- Step 3: Append actual citation info ---
         if retrieved_docs:
             citation_lines = []
             for i, doc in enumerate(retrieved_docs):
-                title = doc.get("title", "Untitled Document")
                 full_snippet = doc.get("content", "").strip().replace('\n', ' ')
-                teaser = full_snippet[:100]
-                full_snippet = auto_link(full_snippet)
-
-                citation_lines.append(
-                    f'<p style="background-color:#f3f4f6; padding:8px; border-radius:4px; margin:0px;">'
-                    f'<strong>[{i+1}]{title}</strong> – {teaser}... <details><summary style="cursor:pointer; color:#555; margin:0px; margin-top:2px;">Read more</summary>{full_snippet}</details>'
-                    f'</p>'
-                )
+                citation_lines.append(_CITATION_TEMPLATE.format(
+                    index=i + 1,
+                    title=doc.get("title", "Untitled Document"),
+                    teaser=full_snippet[:100],
+                    snippet=_URL_RE.sub(_link_url, full_snippet)
+                ))
 
             citation_section = "\n".join(citation_lines)
             full_response = (
@@ -330,17 +504,15 @@ async def chat(request: ChatRequest):
         else:
             full_response = clean_response
      
-        if "The requested information is not available" in clean_response:
-            full_response.append("Disable RagSearch, select another Rag Database, or redefine your question.")
-        if "The requested information is not found" in clean_response:
-            full_response.append("Disable RagSearch, select another Rag Database, or redefine your question.")
+        if no_info:
+            full_response += _NO_INFO_HINT
         # logger.info(full_response)
         # logger.info(completion.choices[0])
 
         # --- Step 4: Return the final payload ---
         response_data = {
             "response": full_response,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now_iso(),
             "retrieved_docs": retrieved_docs
         }
         # response_data = {
@@ -348,6 +520,12 @@ async def chat(request: ChatRequest):
         #     "timestamp": datetime.now().isoformat(),
         # }
 
+        if exact_key is not None:
+            cached = {"response": full_response, "retrieved_docs": retrieved_docs}
+            chat_response_cache[exact_key] = cached
+            if cache_entry is not None:
+                semantic_cache.put(*cache_entry, cached)
+
         logger.info("Successfully processed chat request")
         return response_data
         
@@ -359,8 +537,30 @@ async def chat(request: ChatRequest):
             detail=str(e)
         )
 
+async def semantic_cache_entry(messages: List[Dict[str, str]], vector_search_enabled: bool):
+    """(embedding of the latest message, context hash) for the semantic cache, None to bypass it"""
+    latest = messages[-1]["content"] if len(messages) > 1 else ""
+    if len(latest.strip()) < SEMANTIC_CACHE_MIN_CHARS:
+        return None
+    try:
+        embedding = await client.embeddings.create(
+            model=settings.vector_search_settings.embedding_deployment,
+            input=latest
+        )
+    except Exception as e:
+        logger.warning(f"Semantic cache embedding failed, skipping cache: {e}")
+        return None
+    return embedding.data[0].embedding, context_hash(messages, vector_search_enabled)
+
 @app.post("/translate", response_model=TranslationResponse)
 async def translate_code(req: TranslationRequest):
+    cache_key = None
+    if len(req.source) <= TRANSLATION_CACHE_MAX_SOURCE:
+        cache_key = hashlib.sha256(f"{req.sourceLang}|{req.targetLang}|{req.source}".encode()).digest()
+        cached = translation_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     # Compose a prompt for your chat model that instructs translation
     prompt = (
         f"Translate the following code from {req.sourceLang} to {req.targetLang}:\n\n"
@@ -369,7 +569,7 @@ async def translate_code(req: TranslationRequest):
     )
     
     messages = [
-        {"role": "system", "content": settings.system_prompt},
+        _SYSTEM_MESSAGE,
         {"role": "user", "content": prompt},
     ]
     
@@ -385,12 +585,52 @@ async def translate_code(req: TranslationRequest):
             vector_search_enabled=False
         )
         translated_code = completion.choices[0].message.content.strip()
-        return TranslationResponse(translatedCode=translated_code)
+        response = TranslationResponse(translatedCode=translated_code)
+        if cache_key is not None:
+            translation_cache[cache_key] = response
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
+def build_vector_data_source(search_endpoint: str, search_key: str, search_index: str) -> Dict[str, Any]:
+    """Azure Search data source for chat completions on your data"""
+    vector_search = settings.vector_search_settings
+    return {
+        "type": "azure_search",
+        "parameters": {
+            "endpoint": str(search_endpoint),
+            "key": search_key,
+            "index_name": search_index,
+            "semantic_configuration": vector_search.semantic_config,
+            "query_type": "vector_simple_hybrid",
+            "fields_mapping": {},
+            "in_scope": True,
+            "role_information": settings.system_prompt,
+            "strictness": 3,
+            "top_n_documents": 5,
+            "filter": "",  # Add any filtering conditions if needed
+            "authentication": {
+                "type": "api_key",
+                "key": vector_search.key
+            },
+            "embedding_dependency": {
+                "type": "deployment_name",
+                "deployment_name": vector_search.embedding_deployment
+            }
+        }
+    }
+
+@lru_cache(maxsize=1)
+def default_vector_data_sources() -> List[Dict[str, Any]]:
+    """
+    data_sources for the configured index. Every field comes from settings, so it is built
+    once and shared between requests; treat the returned list as read-only.
+    """
+    vector_search = settings.vector_search_settings
+    return [build_vector_data_source(vector_search.endpoint, vector_search.key, vector_search.index_name)]
+
 async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: int, temperature: float, stream: bool = False, vector_search_endpoint: str='', vector_search_key: str='', vector_search_index:str='', vector_search_enabled: bool = False):
     """
     Generate chat completion with optional vector search and streaming.
@@ -407,11 +647,10 @@ async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: i
     Returns:
         Completion result or stream of results.
     """
-    search_endpoint = vector_search_endpoint or settings.vector_search_endpoint
-    search_key = vector_search_key or settings.vector_search_key
-    search_index = vector_search_index or settings.vector_search_index
-
     try:
+        # Keep the system prompt first and byte-identical across requests (no timestamps or
+        # per-request text in it), followed by the history in order: Azure OpenAI reuses its
+        # cached prompt prefix only when the leading tokens match exactly
         completion_kwargs = {
             "model": settings.openai_deployment_name,
             "messages": messages,
@@ -424,6 +663,11 @@ async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: i
         }
         
         if vector_search_enabled:
+            vector_search = settings.vector_search_settings
+            search_endpoint = vector_search_endpoint or vector_search.endpoint
+            search_key = vector_search_key or vector_search.key
+            search_index = vector_search_index or vector_search.index_name
+
             # Validate required settings
             if not all([
                 search_endpoint,
@@ -433,48 +677,20 @@ async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: i
                 logger.error("Vector search is enabled but required settings are missing")
                 raise ValueError("Incomplete vector search configuration")
 
-            # Configure vector search with explicit data source
-            completion_kwargs["extra_body"] = {
-                "data_sources": [{
-                    "type": "azure_search",
-                    "parameters": {
-                        "endpoint": str(search_endpoint),
-                        "key": search_key,
-                        "index_name": search_index,
-                        "semantic_configuration": settings.vector_search_semantic_config,
-                        "query_type": "vector_simple_hybrid",
-                        "fields_mapping": {},
-                        "in_scope": True,
-                        "role_information": settings.system_prompt,
-                        "strictness": 3,
-                        "top_n_documents": 5,
-                        "filter": "",  # Add any filtering conditions if needed
-                        "authentication": {
-                            "type": "api_key",
-                            "key": settings.vector_search_key
-                        },
-                        "embedding_dependency": {
-                            "type": "deployment_name",
-                            "deployment_name": settings.vector_search_embedding_deployment
-                        }
-                    }
-                }]
-            }
+            # Configure vector search with explicit data source, the configured index is built once
+            if (search_endpoint, search_key, search_index) == (vector_search.endpoint, vector_search.key, vector_search.index_name):
+                data_sources = default_vector_data_sources()
+            else:
+                data_sources = [build_vector_data_source(search_endpoint, search_key, search_index)]
+            completion_kwargs["extra_body"] = {"data_sources": data_sources}
             
             logger.info(f"Vector search enabled with index: {search_index}")
-            #logger.debug(f"Vector search configuration: {completion_kwargs['extra_body']}")
+            #logger.debug("Vector search configuration: %s", completion_kwargs['extra_body'])
         
-        logger.debug(f"Calling OpenAI with parameters: {completion_kwargs}")
+        logger.debug("Calling OpenAI with parameters: %s", completion_kwargs)
         
-        if stream:
-            async def stream_generator():
-                stream_response = client.chat.completions.create(**completion_kwargs)
-                for chunk in stream_response:
-                    yield chunk
-            return stream_generator()
-        else:
-            completion = client.chat.completions.create(**completion_kwargs)
-            return completion
+        # With stream=True this is an async iterator of chunks
+        return await client.chat.completions.create(**completion_kwargs)
 
         
     except Exception as e:
@@ -485,134 +701,188 @@ async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: i
             detail=f"OpenAI API error: {str(e)}"
         )
 
+N_SHARDS = 16  # Power of two so the shard index is a mask
+
+
+class _ConnectionShard:
+    """One slice of the connection tables with its own lock"""
+    __slots__ = ('active_connections', 'connection_times', 'stream_tasks', 'stop_events', 'client_locks', 'lock')
+
+    def __init__(self):
+        self.active_connections: Dict[str, WebSocket] = {}
+        self.connection_times: Dict[str, float] = {}  # loop.time() (monotonic) at connect
+        self.stream_tasks: Dict[str, asyncio.Task] = {}  # Track active stream tasks
+        self.stop_events: Dict[str, asyncio.Event] = {}  # Stop events for each connection
+        self.client_locks: Dict[str, asyncio.Lock] = {}  # Per-client stream start/stop
+        self.lock = asyncio.Lock()  # Only guards structural changes to this shard
+
+
 class ConnectionManager:
     def __init__(self, max_connections: int = 100, timeout: int = 600):
-        self.active_connections: Dict[str, WebSocket] = {}  # Change to dict for better tracking
+        # Connections are split over independent shards by hash(client_id), so a slow
+        # accept/close for one client only holds up the clients of the same shard
+        self._shards: List[_ConnectionShard] = [_ConnectionShard() for _ in range(N_SHARDS)]
         self.max_connections = max_connections
         self.timeout = timeout
-        self.connection_times: Dict[str, datetime] = {}
+        self._deadlines: List[Tuple[float, str]] = []  # Heap of (timeout deadline, client_id)
+        self._expire_handle: Optional[asyncio.TimerHandle] = None
         self._cleanup_task: Optional[asyncio.Task] = None
-        self._lock = asyncio.Lock()
-        self.stream_tasks: Dict[str, asyncio.Task] = {}  # Track active stream tasks
-        self.stop_events: Dict[str, asyncio.Event] = {}  # Stop events for each connection
+        # Slots reserved by connects still waiting on accept(); the admission check and the
+        # reservation happen without an await in between, so shards can't overshoot the limit
+        self._admitting = 0
+
+    def shard(self, client_id: str) -> _ConnectionShard:
+        return self._shards[hash(client_id) & (N_SHARDS - 1)]
 
     async def connect(self, websocket: WebSocket) -> bool:
         client_id = f"{websocket.client.host}:{websocket.client.port}"
+        shard = self.shard(client_id)
         
-        async with self._lock:
+        async with shard.lock:
             # Check if this client already has a connection
-            if client_id in self.active_connections:
+            if client_id in shard.active_connections:
                 logger.warning(f"Client {client_id} already has an active connection")
                 try:
                     await self.disconnect_cleanup(client_id)
                 except Exception:
                     pass
 
-            # Check total connections
-            if len(self.active_connections) >= self.max_connections:
+            # Check total connections, counting connects that are still being accepted
+            if self.get_connection_count() + self._admitting >= self.max_connections:
                 logger.warning(f"Maximum connection limit reached ({self.max_connections})")
                 await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
                 return False
 
+            self._admitting += 1
             try:
                 await websocket.accept()
-                self.active_connections[client_id] = websocket
-                self.connection_times[client_id] = datetime.now()
-                self.stop_events[client_id] = asyncio.Event()  # Create stop event for this connection
-                logger.info(f"Client {client_id} connected. Active connections: {len(self.active_connections)}")
+                shard.active_connections[client_id] = websocket
+                connected_at = asyncio.get_running_loop().time()
+                shard.connection_times[client_id] = connected_at
+                shard.stop_events[client_id] = asyncio.Event()  # Create stop event for this connection
+                shard.client_locks[client_id] = asyncio.Lock()
+                logger.info(f"Client {client_id} connected. Active connections: {self.get_connection_count()}")
                 
-                if self._cleanup_task is None or self._cleanup_task.done():
-                    self._cleanup_task = asyncio.create_task(self._periodic_cleanup())
+                # Deadlines only grow, so a timer is only needed when none is pending
+                heapq.heappush(self._deadlines, (connected_at + self.timeout, client_id))
+                if self._expire_handle is None:
+                    self._schedule_expiry()
                 
                 return True
             except Exception as e:
                 logger.error(f"Error accepting connection from {client_id}: {e}")
                 return False
+            finally:
+                # The slot is either taken by the inserted connection or given back
+                self._admitting -= 1
 
     async def disconnect_cleanup(self, client_id: str):
-        """Clean up resources for a specific client"""
-        if client_id in self.stream_tasks:
-            task = self.stream_tasks[client_id]
-            if not task.done():
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-            del self.stream_tasks[client_id]
+        """Clean up resources for a specific client (caller holds the shard lock)"""
+        shard = self.shard(client_id)
+        task = shard.stream_tasks.pop(client_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
         
-        if client_id in self.stop_events:
-            del self.stop_events[client_id]
+        shard.stop_events.pop(client_id, None)
             
-        if client_id in self.active_connections:
-            ws = self.active_connections[client_id]
-            del self.active_connections[client_id]
+        ws = shard.active_connections.pop(client_id, None)
+        if ws is not None:
             with contextlib.suppress(Exception):
                 await ws.close()
                 
-        if client_id in self.connection_times:
-            del self.connection_times[client_id]
+        shard.connection_times.pop(client_id, None)
+        shard.client_locks.pop(client_id, None)
+
+    def client_lock(self, client_id: str) -> asyncio.Lock:
+        """Lock for swapping/stopping one client's stream without blocking other clients"""
+        return self.shard(client_id).client_locks.setdefault(client_id, asyncio.Lock())
 
     async def disconnect(self, websocket: WebSocket):
         client_id = f"{websocket.client.host}:{websocket.client.port}"
-        async with self._lock:
+        async with self.shard(client_id).lock:
             await self.disconnect_cleanup(client_id)
-            logger.info(f"Client {client_id} disconnected. Active connections: {len(self.active_connections)}")
+            logger.info(f"Client {client_id} disconnected. Active connections: {self.get_connection_count()}")
 
     async def stop_stream(self, client_id: str):
         """Signal to stop the current stream for a client"""
-        async with self._lock:
-            if client_id in self.stop_events:
-                self.stop_events[client_id].set()
+        stop_events = self.shard(client_id).stop_events
+        async with self.client_lock(client_id):
+            if client_id in stop_events:
+                stop_events[client_id].set()
                 logger.info(f"Stop signal sent for client {client_id}")
 
-    async def _periodic_cleanup(self):
-        while True:
-            try:
-                await asyncio.sleep(30)  # Check every 30 seconds
-                async with self._lock:
-                    now = datetime.now()
-                    stale_connections = []
-                    
-                    for client_id, ws in self.active_connections.items():
-                        # FIXED: Use WebSocketState enum for connection check
-                        if ws.client_state == WebSocketState.DISCONNECTED:
-                            stale_connections.append(client_id)
-                        elif (now - self.connection_times[client_id]).total_seconds() > self.timeout:
-                            stale_connections.append(client_id)
-                        
-                    for client_id in stale_connections:
+    def _schedule_expiry(self):
+        """Arm a timer for the earliest connection deadline instead of polling"""
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        if self._deadlines:
+            loop = asyncio.get_running_loop()
+            self._expire_handle = loop.call_at(self._deadlines[0][0], self._on_deadline)
+
+    def _on_deadline(self):
+        self._expire_handle = None
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._expire_connections())
+
+    async def _expire_connections(self):
+        """Disconnect clients whose timeout passed, only touching expired heap entries"""
+        try:
+            now = asyncio.get_running_loop().time()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, client_id = heapq.heappop(self._deadlines)
+                # Only the expired client's shard is locked, and only for its own cleanup
+                shard = self.shard(client_id)
+                async with shard.lock:
+                    # Skip entries of clients that already left or reconnected since
+                    connected_at = shard.connection_times.get(client_id)
+                    if connected_at is not None and connected_at + self.timeout <= now:
                         await self.disconnect_cleanup(client_id)
-                            
-            except Exception as e:
-                logger.error(f"Error in periodic cleanup: {e}")
+        except Exception as e:
+            logger.error(f"Error in connection cleanup: {e}")
+        finally:
+            self._schedule_expiry()
 
     def get_connection_count(self) -> int:
-        return len(self.active_connections)
+        return sum(len(shard.active_connections) for shard in self._shards)
 
     def get_connection_info(self) -> dict:
+        # Lock-free: works on a snapshot of each shard's connection times
+        now = asyncio.get_running_loop().time()
+        wall_now = time.time()
         return {
-            "total_connections": len(self.active_connections),
+            "total_connections": self.get_connection_count(),
             "max_connections": self.max_connections,
             "clients": [
                 {
                     "id": client_id,
-                    "connected_at": self.connection_times[client_id].isoformat(),
-                    "duration": (datetime.now() - self.connection_times[client_id]).total_seconds(),
-                    "has_active_stream": client_id in self.stream_tasks
+                    "connected_at": datetime.fromtimestamp(wall_now - (now - connected_at)).isoformat(),
+                    "duration": now - connected_at,
+                    "has_active_stream": client_id in shard.stream_tasks
                 }
-                for client_id in self.active_connections
+                for shard in self._shards
+                for client_id, connected_at in list(shard.connection_times.items())
             ]
         }
 
 
+# Files of one /upload-files request uploaded in parallel
+UPLOAD_CONCURRENCY = 8
+
 @app.post("/upload-files")
 async def upload_files(files: List[UploadFile] = File(...), background_tasks: BackgroundTasks = None):
-    uploaded_file_urls = []
-    for file in files:
-        # Upload file to Azure Blob Storage
-        blob_url = await upload_file_to_blob_storage(file)
-        uploaded_file_urls.append(blob_url)
+    # Upload files to Azure Blob Storage concurrently, a few at a time
+    upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload(file: UploadFile) -> str:
+        async with upload_slots:
+            return await upload_file_to_blob_storage(file)
+
+    uploaded_file_urls = list(await asyncio.gather(*(upload(file) for file in files)))
 
     # Trigger background ingestion to Cognitive Search
     if background_tasks:
@@ -620,15 +890,29 @@ async def upload_files(files: List[UploadFile] = File(...), background_tasks: Ba
 
     return {"uploaded_files": uploaded_file_urls, "message": "Upload started"}
 
-async def upload_file_to_blob_storage(file: UploadFile) -> str:
+@lru_cache(maxsize=1)
+def blob_service_client():
+    """Blob service client shared by all uploads, so they reuse one connection pool"""
     from azure.storage.blob.aio import BlobServiceClient
+    return BlobServiceClient.from_connection_string(settings.azure_storage_connection_string)
 
-    blob_service_client = BlobServiceClient.from_connection_string(settings.azure_storage_connection_string)
-    container_client = blob_service_client.get_container_client(settings.azure_storage_container)
+@lru_cache(maxsize=1)
+def blob_container_client():
+    return blob_service_client().get_container_client(settings.azure_storage_container)
 
+async def upload_file_to_blob_storage(file: UploadFile) -> str:
+    container_client = blob_container_client()
     blob_client = container_client.get_blob_client(file.filename)
-    contents = await file.read()
-    await blob_client.upload_blob(contents, overwrite=True)
+    # Hand the spooled upload file to the SDK, which reads and stages it in blocks
+    # instead of holding a full copy of the payload in memory
+    await file.seek(0)
+    await blob_client.upload_blob(
+        file.file,
+        length=file.size,
+        overwrite=True,
+        blob_type="BlockBlob",
+        max_concurrency=4
+    )
 
     return blob_client.url
 
@@ -659,8 +943,23 @@ manager = ConnectionManager()
 logger = logging.getLogger(__name__)
 
  
+# Characters that end a sentence and trigger a flush of the stream buffer
+_FLUSH_ENDINGS = frozenset('.!?\n')
+_TRAILING_SPACE = frozenset(' \t\r')
+
+def _last_significant_char(content: str) -> Optional[str]:
+    """Last character of content that isn't a space/tab/CR, None if there is none"""
+    for i in range(len(content) - 1, -1, -1):
+        if content[i] not in _TRAILING_SPACE:
+            return content[i]
+    return None
+
 async def stream_generator(stream, stop_event: asyncio.Event, min_buffer_length: int = 50):
-    buffer = ""
+    # Chunks are collected in a list and joined once per flush, string += would copy
+    # the whole buffer on every delta
+    parts: List[str] = []
+    buffered_length = 0
+    tail_char = None  # Last significant character in the buffer, only new deltas can change it
     first_message_buffering = True
     try:
         async for chunk in stream:
@@ -668,15 +967,21 @@ async def stream_generator(stream, stop_event: asyncio.Event, min_buffer_length:
                 break
             if chunk and chunk.choices and chunk.choices[0].delta.content:
                 content = chunk.choices[0].delta.content
-                buffer += content
+                parts.append(content)
+                buffered_length += len(content)
+                last_char = _last_significant_char(content)
+                if last_char is not None:
+                    tail_char = last_char
 
                 finish_reason = chunk.choices[0].finish_reason
 
                 # Handle max token reached - cut off response
                 if finish_reason == 'length':
                     # Message cut off due to max token limit
+                    buffer = ''.join(parts)
+                    parts.clear()
+                    buffered_length = 0
                     yield buffer
-                    buffer = ""
                     logger.info("Max tokens reached during streaming")
                     # Optionally, you could send a special signal here to indicate truncation
                     break
@@ -684,35 +989,113 @@ async def stream_generator(stream, stop_event: asyncio.Event, min_buffer_length:
                 # Handle normal end of message - yield and break stream
                 elif finish_reason == 'stop':
                     # Normal end of message
-                    yield buffer
-                    buffer = ""
+                    buffer = ''.join(parts)
+                    parts.clear()
+                    buffered_length = 0
                     first_message_buffering = False
+                    yield buffer
                     logger.info("Normal end of message")
                     break
 
-                # If first message and chunk has finish_reason 'stop', yield whole buffer once
-                if first_message_buffering and chunk.choices[0].finish_reason == 'stop':
-                    yield buffer
-                    buffer = ""
-                    first_message_buffering = False
-                elif first_message_buffering:
-                    # Otherwise keep buffering
+                if first_message_buffering:
+                    # Keep buffering until the first message ends
                     pass
                 else:
                     # For subsequent messages, yield when buffer grows enough or ends with punctuation
-                    if len(buffer) >= min_buffer_length or buffer.rstrip().endswith(('.', '!', '?', '\n')):
+                    if buffered_length >= min_buffer_length or tail_char in _FLUSH_ENDINGS:
+                        buffer = ''.join(parts)
+                        parts.clear()
+                        buffered_length = 0
+                        tail_char = None
                         yield buffer
-                        buffer = ""
 
         # Yield any remaining content after stream ends
-        if buffer:
-            yield buffer
+        if parts:
+            yield ''.join(parts)
 
     except Exception as e:
         if not stop_event.is_set():
             print(f"Error in stream_generator: {str(e)}")
         raise
 
+async def send_coalesced(websocket: WebSocket, chunks, stop_event: asyncio.Event,
+                         max_chars: int = 2048, flush_interval: float = 0.005,
+                         max_backlog_chars: int = 256 * 1024, send_timeout: float = 10.0):
+    """
+    Send the strings from `chunks` over the websocket, merging chunks that arrive within
+    flush_interval seconds (up to max_chars) into a single text frame.
+    The bounded queue applies backpressure to the producer when the socket is slow: chunks
+    that queue up while a send is in flight go out together in the next frame (up to
+    max_backlog_chars), and a client that can't take a frame within send_timeout seconds
+    gets its stream stopped instead of having tokens pile up in server memory.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+    done = object()
+    writer_failed = asyncio.Event()
+
+    async def send(text: str):
+        try:
+            await asyncio.wait_for(websocket.send_text(text), timeout=send_timeout)
+        except asyncio.TimeoutError:
+            stop_event.set()
+            logger.warning(f"Websocket client not reading for {send_timeout}s, stopping the stream")
+            raise
+
+    async def writer():
+        batch: List[str] = []
+        batch_length = 0
+        finished = False
+        try:
+            while not finished:
+                try:
+                    if batch:
+                        item = await asyncio.wait_for(queue.get(), timeout=flush_interval)
+                    else:
+                        item = await queue.get()
+                except asyncio.TimeoutError:
+                    item = None  # Nothing arrived in time, flush what we have
+                if item is done:
+                    finished = True
+                elif item is not None:
+                    if stop_event.is_set():
+                        continue  # Generation stopped, drop what is still queued
+                    batch.append(item)
+                    batch_length += len(item)
+                    if batch_length < max_chars:
+                        continue
+                # Merge the backlog that built up while the previous send was in flight
+                while not finished and batch_length < max_backlog_chars and not queue.empty():
+                    item = queue.get_nowait()
+                    if item is done:
+                        finished = True
+                    else:
+                        batch.append(item)
+                        batch_length += len(item)
+                if batch and not stop_event.is_set():
+                    await send(''.join(batch))
+                batch.clear()
+                batch_length = 0
+        except Exception:
+            # Keep draining so the producer never blocks on a full queue, then re-raise
+            writer_failed.set()
+            while await queue.get() is not done:
+                pass
+            raise
+
+    writer_task = asyncio.create_task(writer())
+    try:
+        async for content in chunks:
+            if writer_failed.is_set():
+                break
+            await queue.put(content)
+        await queue.put(done)
+        await writer_task
+    finally:
+        if not writer_task.done():
+            writer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await writer_task
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time chat functionality with proper stream handling"""
@@ -722,6 +1105,7 @@ async def websocket_endpoint(websocket: WebSocket):
         # Only proceed if we successfully connect
         if not await manager.connect(websocket):
             return
+        shard = manager.shard(client_id)
 
         while True:
             try:
@@ -730,14 +1114,22 @@ async def websocket_endpoint(websocket: WebSocket):
                     logger.warning(f"WebSocket not connected for {client_id}")
                     break
 
-                data = await websocket.receive_text()
+                # Take the frame payload as delivered (bytes for binary frames, str for text)
+                # and hand it straight to orjson, no extra decode/encode round trip
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                data = message.get("bytes")
+                if data is None:
+                    data = message.get("text", "")
                 logger.info("Received WebSocket message")
-                logger.debug(f"Message content: {data[:100]}...")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Message content: %r...", data[:100])
                 
                 try:
-                    request_data = json.loads(data)
-                    logger.debug(f"Parsed request data: {request_data}")
-                except json.JSONDecodeError as e:
+                    request_data = orjson.loads(data)
+                    logger.debug("Parsed request data: %s", request_data)
+                except orjson.JSONDecodeError as e:
                     error_msg = f"Invalid JSON format: {str(e)}"
                     logger.error(error_msg)
                     await websocket.send_text(error_msg)
@@ -750,7 +1142,8 @@ async def websocket_endpoint(websocket: WebSocket):
                     continue
                 
                 try:
-                    chat_request = ChatRequest(**request_data)
+                    # Lax mode coerces "0.5" -> 0.5 etc. like Pydantic does
+                    chat_request = msgspec.convert(request_data, ChatRequestFast, strict=False)
                 except Exception as e:
                     error_msg = f"Invalid request format: {str(e)}"
                     logger.error(error_msg)
@@ -758,16 +1151,11 @@ async def websocket_endpoint(websocket: WebSocket):
                     continue
                 
                 # Clear any previous stop event and create a new one
-                async with manager._lock:
-                    if client_id in manager.stop_events:
-                        manager.stop_events[client_id].clear()
+                async with manager.client_lock(client_id):
+                    if client_id in shard.stop_events:
+                        shard.stop_events[client_id].clear()
                 
-                messages = [
-                    {"role": "system", "content": settings.system_prompt}
-                ] + [
-                    {"role": m.role, "content": m.content} 
-                    for m in chat_request.messages
-                ]
+                messages = [_SYSTEM_MESSAGE, *({"role": m.role, "content": m.content} for m in chat_request.messages)]
                 
                 try:
                     stream = await generate_chat_completion(
@@ -784,17 +1172,17 @@ async def websocket_endpoint(websocket: WebSocket):
                     # Create a task for the stream processing
                     async def process_stream():
                         try:
-                            async for content in stream_generator(stream, manager.stop_events[client_id]):
-                                await websocket.send_text(content)
+                            stop_event = shard.stop_events[client_id]
+                            await send_coalesced(websocket, stream_generator(stream, stop_event), stop_event)
                         except Exception as e:
-                            if not manager.stop_events[client_id].is_set():
+                            if not shard.stop_events[client_id].is_set():
                                 await websocket.send_text(f"Error: {str(e)}")
                                 raise
                     
                     # Store and manage the stream task
-                    async with manager._lock:
-                        if client_id in manager.stream_tasks:
-                            old_task = manager.stream_tasks[client_id]
+                    async with manager.client_lock(client_id):
+                        if client_id in shard.stream_tasks:
+                            old_task = shard.stream_tasks[client_id]
                             if not old_task.done():
                                 old_task.cancel()
                                 try:
@@ -802,13 +1190,13 @@ async def websocket_endpoint(websocket: WebSocket):
                                 except asyncio.CancelledError:
                                     pass
                         
-                        manager.stream_tasks[client_id] = asyncio.create_task(process_stream())
+                        shard.stream_tasks[client_id] = asyncio.create_task(process_stream())
                     
                     # Wait for the task to complete
-                    await manager.stream_tasks[client_id]
+                    await shard.stream_tasks[client_id]
                     
                 except Exception as e:
-                    if not manager.stop_events[client_id].is_set():  # Only log if it wasn't a manual stop
+                    if not shard.stop_events[client_id].is_set():  # Only log if it wasn't a manual stop
                         error_msg = f"OpenAI API error: {str(e)}"
                         logger.error(error_msg)
                         logger.exception(e)
@@ -843,58 +1231,85 @@ async def websocket_endpoint(websocket: WebSocket):
         await manager.disconnect(websocket)
 
 
+@lru_cache(maxsize=8)
+def get_encoder(model_name: str) -> tiktoken.Encoding:
+    """Tokenizer for a model, loaded once per process (loading the BPE ranks is slow)"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Azure deployment names aren't model names, fall back to the GPT-4/3.5 encoding
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# Token counts per (model, content). The system prompt and the chat history are resent
+# with every turn, so most lookups are repeats
+_token_count_cache: LRUCache = LRUCache(maxsize=10_000)
+# tiktoken's batch encoder runs the Rust tokenizer on this many threads without the GIL
+TOKENIZER_THREADS = min(8, os.cpu_count() or 1)
+
+
+def message_token_counts(messages: List[Dict[str, str]], model_name: str) -> List[int]:
+    """Token count of each message's content, encoding only the contents not seen before"""
+    counts = [_token_count_cache.get((model_name, message["content"])) for message in messages]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        encoding = get_encoder(model_name)
+        texts = [messages[i]["content"] for i in missing]
+        if len(texts) == 1:
+            encoded = [encoding.encode(texts[0])]
+        else:
+            encoded = encoding.encode_batch(texts, num_threads=TOKENIZER_THREADS)
+        for i, text, tokens in zip(missing, texts, encoded):
+            counts[i] = _token_count_cache[(model_name, text)] = len(tokens)
+    return counts
+
+
 def count_tokens(messages: List[Dict[str, str]], model_name: str) -> int:
-    encoding = tiktoken.encoding_for_model(model_name)
-    total_tokens = 0
-    for message in messages:
-        total_tokens += len(encoding.encode(message["content"])) + 4  # Rough per message overhead
-    return total_tokens
+    # Rough per message overhead of 4 tokens
+    return sum(message_token_counts(messages, model_name)) + 4 * len(messages)
 
 
 def truncate_messages(messages: List[Dict[str, str]], model_name: str):
-    while count_tokens(messages, model_name) + max_completion_tokens > max_model_tokens:
-        # Remove oldest user/assistant messages (e.g., messages[1]) until fits
-        if len(messages) > 1:
-            messages.pop(1)
-        else:
-            break
+    # Count every message once, then keep a running total while dropping
+    lengths = [count + 4 for count in message_token_counts(messages, model_name)]
+    total = sum(lengths)
+    # Remove oldest user/assistant messages (e.g., messages[1]) until fits
+    drop = 1
+    while total + max_completion_tokens > max_model_tokens and drop < len(messages):
+        total -= lengths[drop]
+        drop += 1
+    del messages[1:drop]
     return messages
 
 # Update the apply_unified_diff function to preserve context
 def apply_unified_diff(original: str, diff_text: str) -> Tuple[str, List[int]]:
-    original_lines = original.splitlines(keepends=True)
     patched = []
     changed = []
+    patched_append = patched.append
+    changed_append = changed.append
     line_num = 0
     
-    # Parse diff lines
-    diff_lines = diff_text.splitlines()
-    i = 0
-    while i < len(diff_lines):
-        line = diff_lines[i]
-        
+    # Single pass over the diff lines, dispatching on the first character
+    for line in diff_text.splitlines():
+        marker = line[:1]
         # Handle context lines
-        if line.startswith(' '):
-            patched.append(line[1:] + '\n')
+        if marker == ' ':
+            patched_append(line[1:])
             line_num += 1
-            i += 1
         # Handle added lines
-        elif line.startswith('+') and not line.startswith('+++'):
-            patched.append(line[1:] + '\n')
-            changed.append(line_num)
-            line_num += 1
-            i += 1
+        elif marker == '+':
+            if not line.startswith('+++'):
+                patched_append(line[1:])
+                changed_append(line_num)
+                line_num += 1
         # Handle removed lines
-        elif line.startswith('-') and not line.startswith('---'):
-            changed.append(line_num)
-            i += 1
-        # Handle block headers
-        elif line.startswith('@@'):
-            i += 1  # Skip block header
-        else:
-            i += 1  # Skip other meta lines
+        elif marker == '-':
+            if not line.startswith('---'):
+                changed_append(line_num)
+        # Block headers (@@) and other meta lines are skipped
     
-    return ''.join(patched), changed
+    # Newlines are added by one join instead of a concatenation per line
+    return ('\n'.join(patched) + '\n' if patched else ''), changed
 
 @app.post("/diff-improve", response_model=CodeDiffResponse)
 async def improve_code_with_diff(request: CodeImprovementRequest):
@@ -955,7 +1370,9 @@ async def improve_code_with_diff(request: CodeImprovementRequest):
         changed_lines = []
         
         if request.generate_full_code and diff_part:
-            improved_code, changed_lines = apply_unified_diff(
+            # Patching multi-KB sources is pure Python work, keep it off the event loop
+            improved_code, changed_lines = await asyncio.to_thread(
+                apply_unified_diff,
                 request.original_code, 
                 diff_part
             )
@@ -980,5 +1397,12 @@ if __name__ == "__main__":
         "main:app",
         host=settings.host,
         port=settings.port,
-        reload=settings.debug
+        reload=settings.debug,
+        # One process per core; each worker keeps its own websocket connections and caches.
+        # A stop command arrives on the websocket that runs the stream, so it's always
+        # handled by the worker that owns it. Reload mode only supports a single process
+        workers=1 if settings.debug else settings.workers,
+        # libuv event loop and the C HTTP parser (uvloop isn't available on Windows)
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
     )
\ No newline at end of file
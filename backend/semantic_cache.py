@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import hnswlib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def context_hash(messages: List[Dict[str, str]], *extra: Any) -> bytes:
+    """
+    sha256 over everything except the latest message (system prompt, history, flags).
+    A cached answer is only reused when this context matches exactly.
+    """
+    digest = hashlib.sha256()
+    for message in messages[:-1]:
+        digest.update(message["role"].encode())
+        digest.update(b"\0")
+        digest.update(" ".join((message["content"] or "").split()).encode())
+        digest.update(b"\0")
+    for value in extra:
+        digest.update(repr(value).encode())
+    return digest.digest()
+
+
+class SemanticCache:
+    """
+    In-process cache of recent responses keyed by the embedding of the latest user message.
+    Lookups are an HNSW nearest-neighbour query, entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, dim: int = 1536, max_entries: int = 10000, ttl: float = 900, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = 1.0 - threshold  # hnswlib cosine distance = 1 - similarity
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=max_entries, ef_construction=200, M=16, allow_replace_deleted=True)
+        self._index.set_ef(50)
+        self._entries: Dict[int, Tuple[bytes, Any]] = {}
+        self._expiry: Deque[Tuple[float, int]] = deque()
+        self._next_label = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self, now: float):
+        # Entries are added in time order, so expired ones are at the front
+        while self._expiry and (self._expiry[0][0] <= now or len(self._entries) >= self.max_entries):
+            _, label = self._expiry.popleft()
+            if self._entries.pop(label, None) is not None:
+                self._index.mark_deleted(label)
+
+    def get(self, vector: List[float], key_hash: bytes) -> Optional[Any]:
+        """Cached value for a similar message in the same context, or None"""
+        now = time.monotonic()
+        self._evict(now)
+        if not self._entries:
+            return None
+        try:
+            labels, distances = self._index.knn_query(np.asarray(vector, dtype=np.float32), k=1)
+        except RuntimeError:
+            return None
+        label, distance = int(labels[0][0]), float(distances[0][0])
+        entry = self._entries.get(label)
+        if entry is None or distance > self.max_distance or entry[0] != key_hash:
+            return None
+        return entry[1]
+
+    def put(self, vector: List[float], key_hash: bytes, value: Any):
+        now = time.monotonic()
+        self._evict(now)
+        label = self._next_label
+        self._next_label += 1
+        self._index.add_items(np.asarray([vector], dtype=np.float32), [label], replace_deleted=True)
+        self._entries[label] = (key_hash, value)
+        self._expiry.append((now + self.ttl, label))
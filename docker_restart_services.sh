@@ -59,7 +59,7 @@ fi
 
 echo "Launching backend..."
 # nohup uvicorn main:app --reload > "$LOG_DIR/backend.log" 2>&1 &
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 > "$LOG_DIR/backend.log" 2>&1 &
+nohup uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools > "$LOG_DIR/backend.log" 2>&1 &
 BACKEND_PID=$!
 sleep 2
 
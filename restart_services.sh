@@ -74,7 +74,7 @@ if ! command -v uvicorn &> /dev/null; then
 fi
 
 echo "Launching backend..."
-nohup uvicorn main:app > "$LOG_DIR/backend.log" 2>&1 &
+nohup uvicorn main:app --loop uvloop --http httptools > "$LOG_DIR/backend.log" 2>&1 &
 #nohup uvicorn main:app --host 0.0.0.0 --port 8000 > "$LOG_DIR/backend.log" 2>&1 &
 BACKEND_PID=$!
 sleep 2